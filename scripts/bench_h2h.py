@@ -0,0 +1,97 @@
+#!/usr/bin/env .venv/bin/python3
+
+# Benchmark translation of a directory of Vim help files to HTML, broken down into
+# phases. Like h2h.py, this is meant to be run from the top-level directory of the
+# repository, as 'scripts/bench_h2h.py'.
+
+import argparse
+import pathlib
+import sys
+import time
+
+root_path = pathlib.Path(__file__).parent.parent
+
+sys.path.append(str(root_path))
+
+from vimhelp.vimh2h import VimH2H  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Vim help translation")
+    parser.add_argument(
+        "--in-dir",
+        "-i",
+        required=True,
+        type=pathlib.Path,
+        help="Directory of Vim doc files (must contain a tags file)",
+    )
+    parser.add_argument(
+        "--project",
+        "-p",
+        choices=("vim", "neovim"),
+        default="vim",
+        help="Vim flavour (default: vim)",
+    )
+    parser.add_argument(
+        "--repeat",
+        "-r",
+        type=int,
+        default=3,
+        help="Number of runs; the best one is reported (default: 3)",
+    )
+    args = parser.parse_args()
+    run(args)
+
+
+def run(args):
+    files = [
+        (p.name, p.read_bytes())
+        for p in sorted(args.in_dir.iterdir())
+        if p.suffix == ".txt" or p.name == "tags"
+    ]
+    total_size = sum(len(content) for _, content in files)
+    print(f"{len(files)} files, {total_size / 1e6:.1f} MB")
+
+    start = time.perf_counter()
+    h2h = VimH2H(
+        mode="online", project=args.project, tags=(args.in_dir / "tags").read_bytes()
+    )
+    print(f"{'tags:':22} {time.perf_counter() - start:7.3f}s")
+
+    def decode():
+        for _, content in files:
+            content.decode()
+
+    def translate_str():
+        for name, content in files:
+            for chunk in h2h.to_html_chunks(name, content.decode()):
+                chunk.encode()
+
+    def translate_bytes():
+        for name, content in files:
+            for chunk in h2h.to_html_chunks(name, content):
+                chunk.encode()
+
+    def translate_only():
+        for name, content in files:
+            for _ in h2h.to_html_chunks(name, content):
+                pass
+
+    for label, f in (
+        ("decode", decode),
+        ("translate (no encode)", translate_only),
+        ("str in, bytes out", translate_str),
+        ("bytes in, bytes out", translate_bytes),
+    ):
+        best = min(timed(f) for _ in range(args.repeat))
+        print(f"{label + ':':22} {best:7.3f}s")
+
+
+def timed(f):
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
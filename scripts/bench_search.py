@@ -0,0 +1,90 @@
+#!/usr/bin/env .venv/bin/python3
+
+# Benchmark full-text search against a directory of Vim help files. Like h2h.py, this is
+# meant to be run from the top-level directory of the repository, as
+# 'scripts/bench_search.py'.
+
+import argparse
+import pathlib
+import random
+import sys
+import time
+import tracemalloc
+
+root_path = pathlib.Path(__file__).parent.parent
+
+sys.path.append(str(root_path))
+
+from vimhelp import fulltext  # noqa: E402
+from vimhelp.vimh2h import VimH2H  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark full-text search")
+    parser.add_argument(
+        "--in-dir",
+        "-i",
+        required=True,
+        type=pathlib.Path,
+        help="Directory of Vim doc files",
+    )
+    parser.add_argument(
+        "--queries",
+        "-n",
+        type=int,
+        default=1000,
+        help="Number of random queries (default: 1000)",
+    )
+    args = parser.parse_args()
+
+    h2h = VimH2H()
+    start = time.perf_counter()
+    files = []
+    for path in sorted(args.in_dir.glob("*.txt")):
+        terms, anchors, length = fulltext.extract_terms(path.read_bytes())
+        files.append((path.name, h2h.html_filename(path.name), terms, anchors, length))
+    print(f"{len(files)} files")
+    print(f"term extraction: {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+    start = time.perf_counter()
+    data = fulltext.SearchIndex.build(files).to_bytes()
+    print(f"index build:     {(time.perf_counter() - start) * 1000:8.1f} ms")
+    print(f"index data:      {len(data) / 1e6:8.2f} MB")
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = fulltext.SearchIndex.from_bytes(data)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"index load:      {elapsed * 1000:8.1f} ms")
+    print(f"index size:      {size / 1e6:8.2f} MB")
+
+    # Queries of one to three random terms of the index (so multi-term queries often
+    # have no results), plus some made of very common terms, the slowest case
+    rng = random.Random(0)
+    queries = [
+        " ".join(rng.choice(index.terms) for _ in range(rng.randint(1, 3)))
+        for _ in range(args.queries)
+    ]
+    queries += ["the", "to the", "of the a is", "vim option", "window buffer"]
+
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    total = sum(timings)
+    print(f"{len(queries)} queries: {total * 1000:8.1f} ms total")
+    for label, t in (
+        ("mean", total / len(timings)),
+        ("median", timings[len(timings) // 2]),
+        ("p99", timings[len(timings) * 99 // 100]),
+        ("max", timings[-1]),
+    ):
+        print(f"{label + ':':12} {t * 1e6:8.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env .venv/bin/python3
+
+# Benchmark tag search against the tags of a directory of Vim help files. Like h2h.py,
+# this is meant to be run from the top-level directory of the repository, as
+# 'scripts/bench_tagsearch.py'.
+
+import argparse
+import json
+import pathlib
+import random
+import sys
+import time
+import tracemalloc
+import zlib
+
+root_path = pathlib.Path(__file__).parent.parent
+
+sys.path.append(str(root_path))
+
+from vimhelp import tagsearch  # noqa: E402
+from vimhelp.vimh2h import VimH2H  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tag search")
+    parser.add_argument(
+        "--in-dir",
+        "-i",
+        required=True,
+        type=pathlib.Path,
+        help="Directory of Vim doc files (must contain a tags file)",
+    )
+    parser.add_argument(
+        "--queries",
+        "-n",
+        type=int,
+        default=2000,
+        help="Number of random queries (default: 2000)",
+    )
+    args = parser.parse_args()
+
+    tags = VimH2H(tags=(args.in_dir / "tags").read_bytes()).sorted_tag_href_pairs()
+    print(f"{len(tags)} tags")
+
+    start = time.perf_counter()
+    index = tagsearch.TagIndex.build(tags)
+    print(f"index build: {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+    # Memory retained by the index, including its own copies of strings (but not the
+    # tags and hrefs it shares with 'tags')
+    tracemalloc.start()
+    index = tagsearch.TagIndex.build(tags)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"index size:  {size / 1e6:8.2f} MB")
+
+    # The two ways the web app can load the index from a 'TagsInfo' entity: building it
+    # from the (compressed JSON) tags, or loading the stored index
+    tags_data = zlib.compress(json.dumps(tags).encode())
+    index_data = index.to_bytes()
+    print(f"tags data:   {len(tags_data) / 1e6:8.2f} MB")
+    print(f"index data:  {len(index_data) / 1e6:8.2f} MB")
+    for label, load in (
+        (
+            "tags load: ",
+            lambda: tagsearch.TagIndex.build(json.loads(zlib.decompress(tags_data))),
+        ),
+        ("index load:", lambda: tagsearch.TagIndex.from_bytes(index_data)),
+    ):
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            load()
+            timings.append(time.perf_counter() - start)
+        print(f"{label} {min(timings) * 1000:8.1f} ms")
+
+    # Memory retained by the loaded index, which owns all of its strings
+    tracemalloc.start()
+    index = tagsearch.TagIndex.from_bytes(index_data)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"loaded size: {size / 1e6:8.2f} MB")
+
+    # Keystroke-style queries (prefixes of real tags, as typed), plus substrings of real
+    # tags, which mostly end up in the slower substring stages
+    rng = random.Random(0)
+    queries = []
+    for tag, _ in rng.sample(tags, args.queries // 2):
+        queries.append(tag[: rng.randint(1, len(tag))])
+        start = rng.randint(0, len(tag) - 1)
+        queries.append(tag[start : rng.randint(start + 1, len(tag))].lower())
+
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        tagsearch.do_handle_tagsearch(index, query)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    total = sum(timings)
+    print(f"{len(queries)} queries: {total * 1000:8.1f} ms total")
+    for label, t in (
+        ("mean", total / len(timings)),
+        ("median", timings[len(timings) // 2]),
+        ("p99", timings[len(timings) * 99 // 100]),
+        ("max", timings[-1]),
+    ):
+        print(f"{label + ':':12} {t * 1e6:8.1f} us")
+
+
+if __name__ == "__main__":
+    main()
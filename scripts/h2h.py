@@ -5,12 +5,11 @@
 # (use "make venv" to create it).
 
 import argparse
+import concurrent.futures
 import os.path
 import pathlib
 import sys
 
-import flask
-
 root_path = pathlib.Path(__file__).parent.parent
 
 sys.path.append(str(root_path))
@@ -58,6 +57,19 @@ def main():
         action="store_true",
         help="Ignore any tags file, always recreate tags from scratch",
     )
+    parser.add_argument(
+        "--cache-dir",
+        "-c",
+        type=pathlib.Path,
+        help="Directory in which to cache translations across runs (default: none)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of files to translate in parallel (default: 1)",
+    )
     parser.add_argument(
         "--profile", "-P", action="store_true", help="Profile performance"
     )
@@ -66,27 +78,16 @@ def main():
     )
     args = parser.parse_args()
 
-    app = flask.Flask(
-        __name__,
-        root_path=pathlib.Path(__file__).resolve().parent,
-        static_url_path="",
-        static_folder="../static",
-        template_folder="../templates",
-    )
-    app.jinja_options["trim_blocks"] = True
-    app.jinja_options["lstrip_blocks"] = True
-
-    with app.app_context():
-        if args.profile:
-            import cProfile
-            import pstats
-
-            with cProfile.Profile() as pr:
-                run(args)
-            stats = pstats.Stats(pr).sort_stats("cumulative")
-            stats.print_stats()
-        else:
+    if args.profile:
+        import cProfile
+        import pstats
+
+        with cProfile.Profile() as pr:
             run(args)
+        stats = pstats.Stats(pr).sort_stats("cumulative")
+        stats.print_stats()
+    else:
+        run(args)
 
 
 def run(args):
@@ -114,19 +115,35 @@ def run(args):
     if args.out_dir is not None:
         args.out_dir.mkdir(exist_ok=True)
 
+    cache = DiskCache(args.cache_dir) if args.cache_dir is not None else None
+
+    infiles = []
     for infile in args.in_dir.iterdir():
         if len(args.basenames) != 0 and infile.name not in args.basenames:
             continue
         if infile.suffix != ".txt" and infile.name != "tags":
             print(f"Ignoring {infile}")
             continue
-        content = infile.read_text()
-        print(f"Processing {infile}...")
-        html = h2h.to_html(infile.name, content)
-        if args.out_dir is not None:
-            with (args.out_dir / f"{infile.name}.html").open("w") as f:
-                f.write(prelude)
-                f.write(html)
+        infiles.append(infile)
+
+    if args.jobs > 1:
+        # The tags are only processed once, above; each worker process gets its own
+        # copy of the translator, and writes its output files itself.
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=init_worker,
+            initargs=(h2h, prelude, cache),
+        ) as executor:
+            futures = [
+                executor.submit(worker_translate, infile, args.out_dir)
+                for infile in infiles
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                print(f"Processed {future.result()}")
+    else:
+        for infile in infiles:
+            print(f"Processing {infile}...")
+            translate(h2h, prelude, cache, infile, args.out_dir)
 
     if args.out_dir is not None:
         print("Symlinking static files...")
@@ -151,4 +168,66 @@ def run(args):
     print("Done.")
 
 
-main()
+def translate(h2h, prelude, cache, infile, out_dir):
+    content = infile.read_text()
+    html = cache.get(h2h, infile.name, content) if cache is not None else None
+    if html is not None:
+        html_chunks = (html,)
+    else:
+        html_chunks = h2h.to_html_chunks(infile.name, content)
+        if cache is not None:
+            html = "".join(html_chunks)
+            cache.put(h2h, infile.name, content, html)
+            html_chunks = (html,)
+    if out_dir is not None:
+        with (out_dir / f"{infile.name}.html").open("w") as f:
+            f.write(prelude)
+            f.writelines(html_chunks)
+    else:
+        for _ in html_chunks:
+            pass
+
+
+class DiskCache:
+    # Keeps the translation of each file, along with the cache key and the tags that
+    # it looked up (see 'VimH2H.cache_key'), so it can be reused in later runs.
+
+    def __init__(self, path):
+        self._path = path
+        path.mkdir(exist_ok=True)
+
+    def get(self, h2h, name, content):
+        try:
+            key_hex, *tags = (self._path / f"{name}.key").read_text().split("\n")
+            if h2h.cache_key(name, content, tags).hex() != key_hex:
+                return None
+            return (self._path / f"{name}.html").read_text()
+        except FileNotFoundError:
+            return None
+
+    def put(self, h2h, name, content, html):
+        tags = sorted(h2h.referenced_tags(name))
+        key = h2h.cache_key(name, content, tags)
+        (self._path / f"{name}.html").write_text(html)
+        (self._path / f"{name}.key").write_text("\n".join((key.hex(), *tags)))
+
+
+_worker_h2h = None
+_worker_prelude = None
+_worker_cache = None
+
+
+def init_worker(h2h, prelude, cache):
+    global _worker_h2h, _worker_prelude, _worker_cache
+    _worker_h2h = h2h
+    _worker_prelude = prelude
+    _worker_cache = cache
+
+
+def worker_translate(infile, out_dir):
+    translate(_worker_h2h, _worker_prelude, _worker_cache, infile, out_dir)
+    return infile
+
+
+if __name__ == "__main__":
+    main()
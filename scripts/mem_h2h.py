@@ -0,0 +1,80 @@
+#!/usr/bin/env .venv/bin/python3
+
+# Check that translating Vim help files to HTML does not leak memory: translate a
+# directory of them several times over, each time with a new translator (as the update
+# handler does), and report the memory still allocated after each run, which should
+# level off after the first. 'test_memory_stays_flat' in tests/test_vimh2h.py checks
+# the same on generated text; this is for checking it on real help files. Like h2h.py,
+# this is meant to be run from the top-level directory of the repository, as
+# 'scripts/mem_h2h.py'.
+
+import argparse
+import gc
+import pathlib
+import sys
+import tracemalloc
+
+root_path = pathlib.Path(__file__).parent.parent
+
+sys.path.append(str(root_path))
+
+from vimhelp import vimh2h  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check Vim help translation for memory leaks"
+    )
+    parser.add_argument(
+        "--in-dir",
+        "-i",
+        required=True,
+        type=pathlib.Path,
+        help="Directory of Vim doc files (must contain a tags file)",
+    )
+    parser.add_argument(
+        "--project",
+        "-p",
+        choices=("vim", "neovim"),
+        default="vim",
+        help="Vim flavour (default: vim)",
+    )
+    parser.add_argument(
+        "--repeat",
+        "-r",
+        type=int,
+        default=4,
+        help="Number of runs (default: 4)",
+    )
+    args = parser.parse_args()
+    run(args)
+
+
+def run(args):
+    files = [
+        (p.name, p.read_bytes())
+        for p in sorted(args.in_dir.iterdir())
+        if p.suffix == ".txt"
+    ]
+    tags = (args.in_dir / "tags").read_bytes()
+    print(f"{len(files)} files")
+
+    tracemalloc.start()
+    for i in range(args.repeat):
+        h2h = vimh2h.VimH2H(mode="online", project=args.project, tags=tags)
+        for name, content in files:
+            for _ in h2h.to_html_chunks(name, content):
+                pass
+        del h2h
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        cached = vimh2h.html_escape.cache_info().currsize
+        print(
+            f"run {i + 1}: {current / 1e6:6.2f} MB allocated,"
+            f" peak {peak / 1e6:6.2f} MB, {cached} escaped strings cached"
+        )
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
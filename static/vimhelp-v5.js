@@ -14,9 +14,23 @@ new TomSelect("#vh-select-tag", {
     },
     shouldLoad: (query) => query.length >= 1,
     load: async (query, callback) => {
-        const url = "/api/tagsearch?q=" + encodeURIComponent(query);
-        const resp = await fetch(url);
-        callback((await resp.json()).results);
+        let results = null;
+        // The tag index only gives exactly the same results as the server for ASCII
+        // queries (JavaScript has no equivalent of Python's casefold()).
+        if (/^[\x20-\x7e]+$/.test(query)) {
+            try {
+                results = await searchTagIndex(query);
+            }
+            catch (e) {
+                console.log("tag index unavailable, falling back to server:", e);
+            }
+        }
+        if (results === null) {
+            const url = "/api/tagsearch?q=" + encodeURIComponent(query);
+            const resp = await fetch(url);
+            results = (await resp.json()).results;
+        }
+        callback(results);
     },
     onChange: (value) => {
         if (value) {
@@ -25,6 +39,73 @@ new TomSelect("#vh-select-tag", {
     }
 });
 
+// Client-side tag search, with the same results as the server's /api/tagsearch (see
+// tagsearch.py), using the tag index (see tagindex.py), which is fetched once
+
+const MAX_RESULTS = 30;
+let tagIndex = null;
+
+const fetchJson = async (url) => {
+    const resp = await fetch(url);
+    if (!resp.ok) {
+        throw new Error(`${url}: ${resp.status}`);
+    }
+    return resp.json();
+};
+
+// Like Python's urllib.parse.quote_plus()
+const quotePlus = (s) => encodeURIComponent(s)
+    .replace(/[!'()*]/g, (c) => "%" + c.charCodeAt(0).toString(16).toUpperCase())
+    .replace(/%20/g, "+");
+
+const getTagIndex = () => {
+    // If this fails, it keeps failing (without further requests) until the next page
+    // load, and the server does all the searching.
+    tagIndex ??= fetchJson("/api/tagindex.json")
+        .then(({hash}) => fetchJson(`/api/tagindex.${hash}.json`))
+        .then(({files, tags}) =>
+            tags.map(([tag, file, href, lower]) => ({
+                tag: tag,
+                lower: lower ?? tag.toLowerCase(),
+                href: href ?? `${files[file]}#${quotePlus(tag)}`
+            })));
+    return tagIndex;
+};
+
+const searchTagIndex = async (query) => {
+    const index = await getTagIndex();
+    const results = [];
+    const resultSet = new Set();
+    const isLower = query === query.toLowerCase();
+
+    const addResult = (item) => {
+        if (!resultSet.has(item.tag)) {
+            results.push({ id: item.tag, text: item.tag, href: item.href });
+            resultSet.add(item.tag);
+        }
+        return results.length === MAX_RESULTS;
+    };
+
+    // Tags beginning with the query (case-sensitively, then not), then tags containing
+    // it (likewise), each in sorted order
+    const stages = [(item) => item.tag.startsWith(query)];
+    if (isLower) {
+        stages.push((item) => item.lower.startsWith(query));
+    }
+    stages.push((item) => item.tag.includes(query));
+    if (isLower) {
+        stages.push((item) => item.lower.includes(query));
+    }
+    for (const matches of stages) {
+        for (const item of index) {
+            if (matches(item) && addResult(item)) {
+                return results;
+            }
+        }
+    }
+    return results;
+};
+
 // Theme switcher
 
 for (let theme of ["theme-native", "theme-light", "theme-dark"]) {
@@ -50,6 +50,12 @@ def lint(c):
     c.run("black --check .")
 
 
+@task
+def test(c):
+    """Run tests (needs pytest)."""
+    c.run(f"{VENV_DIR}/bin/python -m pytest -q tests")
+
+
 @task(help={"gunicorn": "Run using gunicorn instead of 'flask run'"})
 def run(c, gunicorn=False):
     """Run app locally against vimhelp-staging database."""
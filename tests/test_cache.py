@@ -0,0 +1,156 @@
+import datetime
+import types
+
+import gevent
+import gevent.event
+import pytest
+
+from vimhelp import cache
+from vimhelp import sharedstore
+
+
+class Loader:
+    """
+    Load function that returns the next of 'values' on each call (raising it if it is
+    an exception), after waiting for 'release' to be set.
+    """
+
+    def __init__(self, *values):
+        self.values = list(values)
+        self.calls = 0
+        self.release = gevent.event.Event()
+        self.release.set()
+
+    def __call__(self):
+        self.calls += 1
+        value = self.values.pop(0)
+        self.release.wait()
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+def test_concurrent_misses_load_once():
+    c = cache.Cache()
+    load = Loader("value")
+    load.release.clear()
+    greenlets = [gevent.spawn(c.get_or_load, "vim", "key", load) for _ in range(10)]
+    gevent.sleep(0)
+    load.release.set()
+    gevent.joinall(greenlets, raise_error=True)
+    assert [g.value for g in greenlets] == ["value"] * 10
+    assert load.calls == 1
+    assert c.stats["loads"] == 1
+    assert c.stats["coalesced"] == 9
+    assert c.get_or_load("vim", "key", load) == "value"
+    assert load.calls == 1
+
+
+def test_concurrent_misses_share_exception():
+    c = cache.Cache()
+    load = Loader(ValueError("failed"), "value")
+    load.release.clear()
+    greenlets = [gevent.spawn(c.get_or_load, "vim", "key", load) for _ in range(3)]
+    gevent.sleep(0)
+    load.release.set()
+    gevent.joinall(greenlets)
+    assert all(isinstance(g.exception, ValueError) for g in greenlets)
+    assert load.calls == 1
+    # Failures are not cached
+    assert c.get_or_load("vim", "key", load) == "value"
+    assert load.calls == 2
+
+
+@pytest.mark.parametrize("new_generation", ["clear", "revalidate"])
+def test_load_across_new_generation_not_cached(new_generation):
+    c = cache.Cache()
+    old_load = Loader("old")
+    old_load.release.clear()
+    first = gevent.spawn(c.get_or_load, "vim", "key", old_load)
+    gevent.sleep(0)
+    if new_generation == "clear":
+        c.clear("vim")
+    else:
+        c.revalidate("vim", lambda key: True)
+    # Misses after the new generation started don't wait for the old load
+    new_load = Loader("new")
+    assert c.get_or_load("vim", "key", new_load) == "new"
+    old_load.release.set()
+    assert first.get() == "old"
+    # The old load finished last, but its value was not put in the cache
+    assert c.get_or_load("vim", "key", new_load) == "new"
+    assert new_load.calls == 1
+    assert c.stats["coalesced"] == 0
+
+
+@pytest.mark.parametrize("pinned", [False, True])
+def test_stale_entry_served_while_reloading(pinned):
+    c = cache.Cache()
+    load = Loader("old", "new")
+    c.get_or_load("vim", "key", load, pinned)
+    c.get_or_load("vim", "other", lambda: "other")
+    load.release.clear()
+    c.revalidate("vim", lambda key: key == "key")
+    gevent.sleep(0)
+    assert load.calls == 2
+    assert c.get_or_load("vim", "key", load, pinned) == "old"
+    load.release.set()
+    gevent.sleep(0)
+    assert c.get_or_load("vim", "key", load, pinned) == "new"
+    assert load.calls == 2
+    assert c.stats["revalidations"] == 1
+    assert c.info()["pinned_entries"] == (1 if pinned else 0)
+
+
+@pytest.mark.parametrize("pinned", [False, True])
+def test_failed_reload_removes_entry(pinned):
+    c = cache.Cache()
+    load = Loader("old", FileNotFoundError("gone"), "new")
+    c.get_or_load("vim", "key", load, pinned)
+    c.revalidate("vim", lambda key: True)
+    gevent.sleep(0)
+    assert c.stats["revalidation_failures"] == 1
+    assert c.info()["entries"] == 0
+    assert c.get_or_load("vim", "key", load, pinned) == "new"
+    assert load.calls == 3
+
+
+def test_stale_key_checker():
+    is_stale = cache._stale_key_checker(
+        {"same": "1", "changed": "1", "removed": "1"}, {"same": "1", "changed": "2"}
+    )
+    assert not is_stale("same")
+    assert is_stale("changed")
+    assert is_stale("removed")
+    assert is_stale("unknown")
+
+
+def test_switch_store_generation(tmp_path):
+    store = sharedstore.SharedStore(tmp_path, 1 << 20)
+    c = cache.Cache(shared_store=store)
+
+    def g(day):
+        return types.SimpleNamespace(last_update_time=datetime.datetime(2026, 1, day))
+
+    assert c._switch_store_generation("vim", g(1), None) is None
+    old_file = store.current("vim")
+    old_file.put("same", {}, [b"1"])
+    old_file.put("changed", {}, [b"2"])
+    is_stale = c._switch_store_generation(
+        "vim", g(2), lambda key: key in ("changed", "new")
+    )
+    # Only the unchanged record is copied to the new generation's file
+    assert store.current("vim") is not old_file
+    assert store.current("vim").keys() == {"same"}
+    # Entries loaded from the old file are stale too, so that it can be freed
+    assert is_stale("same")
+    assert is_stale("changed")
+    assert is_stale("new")
+    assert not is_stale("other")
+    # Switching to the same generation again changes nothing
+    is_stale = c._switch_store_generation("vim", g(2), lambda key: False)
+    assert not is_stale("same")
+    # Without a last update time, there is no generation to switch to
+    no_time = types.SimpleNamespace(last_update_time=None)
+    assert c._switch_store_generation("vim", no_time, None) is None
+    assert store.current("vim").generation == "20260102000000000000"
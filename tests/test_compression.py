@@ -0,0 +1,54 @@
+import gzip
+import random
+import zlib
+
+import pytest
+
+from vimhelp import compression
+
+
+def random_bytes(rng, n):
+    return bytes(rng.getrandbits(8) for _ in range(n))
+
+
+@pytest.mark.parametrize("len1, len2", [(0, 0), (0, 5), (5, 0), (1, 1), (100, 3000)])
+def test_crc32_combine(len1, len2):
+    rng = random.Random(len1 * 10000 + len2)
+    a = random_bytes(rng, len1)
+    b = random_bytes(rng, len2)
+    assert compression.crc32_combine(
+        zlib.crc32(a), zlib.crc32(b), len(b)
+    ) == zlib.crc32(a + b)
+
+
+def test_crc32_combine_long():
+    # Lengths with many bits set exercise more of the table
+    a = b"abc"
+    b = b"\xff" * (2**20 - 1)
+    assert compression.crc32_combine(
+        zlib.crc32(a), zlib.crc32(b), len(b)
+    ) == zlib.crc32(a + b)
+
+
+@pytest.mark.parametrize(
+    "prelude, body",
+    [
+        (b"", b""),
+        (b"<html>\n", b""),
+        (b"", b"<p>body</p>\n"),
+        (b"<html><head>" * 50, b"<p>" + b"text " * 20000 + b"</p>\n"),
+        (b"\x00\xff" * 1000, bytes(range(256)) * 500),
+    ],
+)
+def test_gzip_chunks(prelude, body):
+    deflater = compression.Deflater()
+    # In pieces, like the translator's output
+    for i in range(0, len(body), 1000):
+        deflater.update(body[i : i + 1000])
+    deflated = deflater.finish()
+    assert deflater.size == len(body)
+    chunks = compression.gzip_chunks(prelude, deflated, deflater.crc32, deflater.size)
+    data = b"".join(chunks)
+    # Checks the CRC-32 and size in the trailer too
+    assert gzip.decompress(data) == prelude + body
+    assert zlib.decompress(data, 16 + zlib.MAX_WBITS) == prelude + body
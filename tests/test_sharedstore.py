@@ -0,0 +1,75 @@
+import datetime
+import gzip
+
+import flask
+import pytest
+
+from vimhelp import compression
+from vimhelp import sharedstore
+from vimhelp import vimhelp
+
+
+BODY = b"<p>" + b"x" * 200_000 + b"</p>\n"
+
+
+def make_page():
+    deflater = compression.Deflater()
+    deflater.update(BODY)
+    deflated = deflater.finish()
+    return vimhelp.CachedPage(
+        "etag",
+        datetime.datetime(2026, 1, 1),
+        b"UTF-8",
+        BODY,
+        (deflated, deflater.crc32, deflater.size),
+    )
+
+
+@pytest.fixture
+def store_file(tmp_path):
+    store = sharedstore.SharedStore(tmp_path, 1 << 20)
+    store.switch_generation("vim", "1")
+    return store.current("vim")
+
+
+def test_range_file(store_file):
+    store_file.put("a", {}, [b"0123"])
+    _, blobs, offset = store_file.put("b", {}, [b"456", b"789"])
+    assert bytes(blobs[1]) == b"789"
+    f = sharedstore.open_range(store_file.path, offset, 6)
+    assert f.tell() == offset
+    assert f.read(4) == b"4567"
+    assert f.read() == b"89"
+    assert f.read() == b""
+    f.seek(offset + 3)
+    assert f.read(100) == b"789"
+    f.close()
+
+
+@pytest.mark.parametrize("theme", [None, "dark"])
+@pytest.mark.parametrize("use_gzip", [False, True])
+def test_serve_from_store(store_file, theme, use_gzip):
+    page = make_page()
+    stored_page = vimhelp.CachedPage.from_record(
+        *store_file.put("page", *page.to_record()), store_file.path
+    )
+    app = flask.Flask("test")
+
+    @app.route("/<name>")
+    def serve(name):
+        p = stored_page if name == "stored" else page
+        resp = vimhelp.prepare_response(
+            flask.request, p.etag, p.modified, p.encoding, theme, use_gzip
+        )
+        resp = vimhelp.complete_response(resp, p, theme, use_gzip)
+        # Sent straight from the file for the default theme only
+        assert resp.direct_passthrough == (name == "stored" and theme is None)
+        return resp
+
+    client = app.test_client()
+    expected = client.get("/plain")
+    resp = client.get("/stored")
+    assert resp.data == expected.data
+    assert resp.headers == expected.headers
+    data = gzip.decompress(resp.data) if use_gzip else resp.data
+    assert data.endswith(BODY)
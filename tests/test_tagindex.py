@@ -0,0 +1,67 @@
+import types
+import urllib.parse
+
+import flask
+import pytest
+
+from vimhelp import tagindex
+
+
+TAGS = [
+    ("'ai'", "options.txt.html#%27ai%27"),
+    ("help.txt", "/#help.txt"),
+    ("i_CTRL-V", "insert.txt.html#i_CTRL-V"),
+    ("ö", "other.txt.html#%C3%B6"),
+]
+
+
+class FakeCache:
+    def __init__(self, data):
+        self._data = data
+
+    def get_or_load(self, project, key, load, pinned=False):
+        return self._data
+
+
+def test_build_index():
+    index, content_hash = tagindex.build_index(TAGS)
+    files = index["files"]
+    hrefs = []
+    for tag, file_index, *rest in index["tags"]:
+        href = rest[0] if rest and rest[0] is not None else None
+        if href is None:
+            href = f"{files[file_index]}#{urllib.parse.quote_plus(tag)}"
+        hrefs.append((tag, href))
+    assert hrefs == TAGS
+    assert index["tags"][3][3] == "ö"
+    assert tagindex.build_index(TAGS)[1] == content_hash
+
+
+@pytest.fixture
+def client():
+    index, content_hash = tagindex.build_index(TAGS)
+    entity = types.SimpleNamespace(index=index, hash=content_hash)
+    cache = FakeCache(tagindex.TagIndexData(entity))
+    app = flask.Flask("test")
+
+    @app.before_request
+    def before():
+        flask.g.project = "vim"
+
+    @app.route("/api/tagindex.json")
+    def manifest():
+        return tagindex.handle_manifest(cache)
+
+    @app.route("/api/tagindex.<content_hash>.json")
+    def index_(content_hash):
+        return tagindex.handle_index(content_hash, cache)
+
+    return app.test_client()
+
+
+def test_fetch_index(client):
+    manifest = client.get("/api/tagindex.json").json
+    resp = client.get(f"/api/tagindex.{manifest['hash']}.json")
+    assert resp.json == tagindex.build_index(TAGS)[0]
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert client.get("/api/tagindex.0123456789abcdef.json").status_code == 404
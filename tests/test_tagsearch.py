@@ -0,0 +1,137 @@
+import contextlib
+import types
+import urllib.parse
+import zlib
+
+import flask
+import pytest
+
+from vimhelp import dbmodel
+from vimhelp import tagsearch
+
+
+class FakeCache:
+    def __init__(self, index):
+        self._index = index
+
+    def get_or_load(self, project, key, load, pinned=False):
+        return self._index
+
+
+@pytest.fixture
+def client():
+    index = tagsearch.TagIndex.build(
+        [
+            ("'ai'", "options.txt.html#%27ai%27"),
+            ("bars", "/#bars"),
+            ("help.txt", "/#help.txt"),
+            ("usr_01.txt/x", "usr_01.txt.html#usr_01.txt%2Fx"),
+        ]
+    )
+    cache = FakeCache(index)
+    app = flask.Flask("test")
+
+    @app.before_request
+    def before():
+        flask.g.project = "vim"
+
+    @app.route("/tag/<path:name>")
+    def tag(name):
+        return tagsearch.handle_tag(name, cache)
+
+    return app.test_client()
+
+
+@pytest.mark.parametrize(
+    "path, location",
+    [
+        ("/tag/help.txt", "../#help.txt"),
+        ("/tag/bars", "../#bars"),
+        ("/tag/'ai'", "../options.txt.html#%27ai%27"),
+        ("/tag/usr_01.txt/x", "../../usr_01.txt.html#usr_01.txt%2Fx"),
+    ],
+)
+def test_tag_redirect(client, path, location):
+    resp = client.get(path)
+    assert resp.status_code == 302
+    assert resp.headers["Location"] == location
+
+
+def test_tag_redirect_to_site_root(client):
+    # Resolved against the request URL, the way a browser does
+    resp = client.get("/tag/help.txt")
+    url = urllib.parse.urljoin("https://vimhelp.org/tag/help.txt", resp.location)
+    assert url == "https://vimhelp.org/#help.txt"
+
+
+def test_tag_not_found(client):
+    assert client.get("/tag/zzzzzz").status_code == 404
+
+
+def test_tag_resolve_metrics(client):
+    def counts(metric):
+        return {
+            tuple(labels.values()): value
+            for suffix, labels, value in metric.samples()
+            if suffix == "_count"
+        }
+
+    stage_counts = counts(tagsearch._STAGE_SECONDS)
+    resolve_counts = counts(tagsearch._RESOLVE_SECONDS)
+    client.get("/tag/help.txt")
+    client.get("/tag/help")
+    # Resolving tags is timed on its own, not as tagsearch stages
+    assert counts(tagsearch._STAGE_SECONDS) == stage_counts
+    for exact in ("true", "false"):
+        new_count = counts(tagsearch._RESOLVE_SECONDS)[(exact,)]
+        assert new_count == resolve_counts.get((exact,), 0) + 1
+
+
+def make_tags(n):
+    # Mixed-case and non-ASCII tags, many sharing substrings, like the real ones
+    words = ["Help", "ab", "'ai'", "cmd", "ÄÖ", "ß", "win", "x-y", ":", "ǅ"]
+    tags = {
+        "".join(words[(i // len(words) ** k) % len(words)] for k in range(3)) + str(i)
+        for i in range(n)
+    }
+    return [(tag, f"t{i % 7}.txt.html#{tag}") for i, tag in enumerate(sorted(tags))]
+
+
+QUERIES = ["", "a", "A", "ab", "help", "HELP", "äö", "ss", "ß", "x-y:", "'ai'c", "9"]
+
+
+@pytest.mark.parametrize("n", [0, 1, 500, 2**15 + 1])
+def test_index_round_trip(n):
+    index = tagsearch.TagIndex.build(make_tags(n))
+    loaded = tagsearch.TagIndex.from_bytes(index.to_bytes())
+    assert loaded.tags == index.tags
+    assert loaded.version == index.version
+    for query in QUERIES + [tag for tag, _ in make_tags(n)[:: max(n // 20, 1)]]:
+        positions = tagsearch.search(index, query)
+        assert tagsearch.search(loaded, query) == positions
+        assert loaded.encode_results(positions) == index.encode_results(positions)
+
+
+@pytest.mark.parametrize(
+    "corrupt",
+    [
+        lambda data: data.replace(b"VHT1", b"VHT0", 1),
+        lambda data: data.replace(
+            b'"ngram_len": %d' % tagsearch.NGRAM_LEN, b'"ngram_len": 0', 1
+        ),
+    ],
+)
+def test_load_index_fallback(monkeypatch, corrupt):
+    tags = make_tags(100)
+    data = tagsearch.TagIndex.build(tags).to_bytes()
+    data = zlib.compress(corrupt(zlib.decompress(data)))
+    entity = types.SimpleNamespace(index=data, tags=tags)
+    monkeypatch.setattr(dbmodel, "ndb_context", contextlib.nullcontext)
+    monkeypatch.setattr(dbmodel.TagsInfo, "get_by_id", lambda project: entity)
+    with pytest.raises(ValueError):
+        tagsearch.TagIndex.from_bytes(data)
+    index = tagsearch.load_index("vim")
+    assert index.tags == [tag for tag, _ in tags]
+    assert tagsearch.search(index, "help") == tagsearch.search(
+        tagsearch.TagIndex.build(tags), "help"
+    )
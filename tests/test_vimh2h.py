@@ -0,0 +1,78 @@
+import gc
+import tracemalloc
+
+import pytest
+
+from vimhelp import vimh2h
+
+
+@pytest.mark.parametrize(
+    "text", ["", "a", "a\nb", "a\r\nb\n", "\n\n", "a\rb\r", "x\n\ny\n\n\n"]
+)
+def test_split_lines(text):
+    assert list(vimh2h.split_lines(text)) == vimh2h.RE_NEWLINE.split(text)
+
+
+def test_to_html_chunks(monkeypatch):
+    rule = "=" * 78 + "\n"
+    contents = (
+        "*test.txt*\tFor Vim version 9.0\n"
+        f"{rule}"
+        "1. Introduction\t\t\t\t\t*test-intro*\n"
+        "\n"
+        "See |test-intro| and 'ai'. Example: >\n"
+        "\t:set ai\n"
+        "<\n"
+        f"{rule}"
+        "\n"
+        "2. Heading without a tag\n"
+        "Text CTRL-V <Esc>.\n"
+    ) * 20
+    h2h = vimh2h.VimH2H(mode="offline", tags=b"test-intro\ttest.txt\t/*test-intro*\n")
+    page = h2h.to_html("test.txt", contents)
+    monkeypatch.setattr(vimh2h, "CONTENT_CHUNK_PIECES", 10)
+    chunks = list(h2h.to_html_chunks("test.txt", contents))
+    assert len(chunks) > 20
+    assert "".join(chunks) == page
+    assert page.count('class="l"') == 20
+    # A heading two lines below a rule
+    assert page.count('<span id="_heading-without-a-tag">') == 20
+
+
+def test_cache_key():
+    h2h = vimh2h.VimH2H(mode="online")
+    key = h2h.cache_key("test.txt", b"text", ["tag"])
+    assert h2h.cache_key("test.txt", b"text", ["tag"]) == key
+    assert h2h.cache_key("test.txt", b"text2", ["tag"]) != key
+    assert h2h.cache_key("test.txt", b"text", ["tag"], format_version=1) != key
+    assert h2h.cache_key("test.txt", b"text", ["tag"], format_version=2) != (
+        h2h.cache_key("test.txt", b"text", ["tag"], format_version=1)
+    )
+
+
+def test_memory_stays_flat():
+    # Each run translates text with new words, with a new translator (like each update
+    # does), so anything kept from one run to the next (such as an unbounded cache)
+    # would keep growing.
+    def run(i):
+        contents = "".join(
+            f"Line {j}: " + " ".join(f"w{i}x{j}x{k}" for k in range(10)) + " |tag|\n"
+            for j in range(2000)
+        )
+        h2h = vimh2h.VimH2H(mode="online", tags=b"tag\ttest.txt\t/*tag*\n")
+        for _ in h2h.to_html_chunks("test.txt", contents):
+            pass
+
+    tracemalloc.start()
+    try:
+        run(0)
+        run(1)
+        gc.collect()
+        before, _ = tracemalloc.get_traced_memory()
+        for i in range(2, 6):
+            run(i)
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert after - before < 100_000
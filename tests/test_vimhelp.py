@@ -0,0 +1,92 @@
+import collections
+import datetime
+import gzip
+
+import flask
+import pytest
+
+from vimhelp import compression
+from vimhelp import vimhelp
+
+
+BODY = b"<p>page</p>\n"
+
+
+class FakeCache:
+    shared_store = None
+
+    def __init__(self, page):
+        self._page = page
+
+    def get_or_load(self, project, key, load, pinned=False):
+        return self._page
+
+
+def make_page(with_gzip=True):
+    deflater = compression.Deflater()
+    deflater.update(BODY)
+    deflated = deflater.finish()
+    return vimhelp.CachedPage(
+        "etag",
+        datetime.datetime(2026, 1, 1),
+        b"UTF-8",
+        BODY,
+        (deflated, deflater.crc32, deflater.size) if with_gzip else None,
+    )
+
+
+def make_app(page):
+    cache = FakeCache(page)
+    app = flask.Flask("test")
+
+    @app.before_request
+    def before():
+        flask.g.project = "vim"
+
+    @app.route("/<filename>.html")
+    def serve(filename):
+        return vimhelp.handle_vimhelp(filename, cache)
+
+    return app, cache
+
+
+def test_warmup_not_counted(monkeypatch):
+    monkeypatch.setattr(vimhelp, "page_request_counts", collections.Counter())
+    app, cache = make_app(make_page())
+    assert app.test_client().get("/options.txt.html").status_code == 200
+    with app.test_request_context():
+        flask.g.project = "vim"
+        vimhelp.handle_vimhelp("", cache, is_warmup=True)
+        vimhelp.handle_vimhelp("options.txt", cache, is_warmup=True)
+    assert vimhelp.page_request_counts == {("vim", "options.txt"): 1}
+
+
+def test_gzip_etag():
+    client = make_app(make_page())[0].test_client()
+    plain = client.get("/options.txt.html")
+    gzipped = client.get("/options.txt.html", headers={"Accept-Encoding": "gzip"})
+    assert plain.headers["ETag"] == '"etag"'
+    assert gzipped.headers["ETag"] == '"etag-gz"'
+    assert gzipped.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(gzipped.data) == plain.data
+    # Each representation only matches its own ETag
+    for headers, etag, status in [
+        ({}, "etag", 304),
+        ({}, "etag-gz", 200),
+        ({"Accept-Encoding": "gzip"}, "etag-gz", 304),
+        ({"Accept-Encoding": "gzip"}, "etag", 200),
+    ]:
+        resp = client.get(
+            "/options.txt.html", headers={**headers, "If-None-Match": f'"{etag}"'}
+        )
+        assert resp.status_code == status
+
+
+@pytest.mark.parametrize("accept_encoding", ["", "gzip"])
+def test_etag_without_gzip(accept_encoding):
+    # Pages that are not kept gzipped are sent uncompressed, with the plain ETag
+    client = make_app(make_page(with_gzip=False))[0].test_client()
+    resp = client.get("/options.txt.html", headers={"Accept-Encoding": accept_encoding})
+    assert resp.headers["ETag"] == '"etag"'
+    assert "Content-Encoding" not in resp.headers
+    assert resp.data.endswith(BODY)
@@ -1,61 +1,359 @@
+import collections
 import logging
+import sys
 import threading
 
 import gevent
+import gevent.event
+import gevent.pool
 
+from . import metrics
 from .dbmodel import GlobalInfo, ndb_context
 
 
 _REFRESH_INTERVAL_SEC = 120
 
+# Maximum number of entries being reloaded at the same time after an update
+_REVALIDATE_CONCURRENCY = 8
+
+# Default memory budget of the cache, for both projects together; can be overridden
+# with the VIMHELP_CACHE_MAX_BYTES environment variable (see webapp.py)
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+_LOOKUPS = metrics.Counter(
+    "vimhelp_cache_lookups_total",
+    "Lookups in the in-process cache, by project and result (hit or miss)",
+    ("project", "result"),
+)
+
 
 class Cache:
-    def __init__(self):
-        self._cache = {}
+    """
+    In-process cache of the objects needed to serve requests (processed pages, search
+    indexes etc.), keyed by project and key. Entries are evicted, least recently used
+    first, to keep their total size within 'max_bytes'; except for pinned entries,
+    which are kept (and still count towards the total) until the project's entries are
+    cleared.
+
+    After a project is updated, only the entries whose data changed are replaced (see
+    '_refresh').
+
+    If 'shared_store' is given (a 'sharedstore.SharedStore'), it is switched to each
+    project's new generation after an update; the loaders of the entries (see
+    vimhelp.py) use it to share their data with the other processes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, shared_store=None):
+        self._max_bytes = max_bytes
+        self.shared_store = shared_store
+        # Map from (project, key) to (value, size, load), where 'load' is the function
+        # that loaded the value
+        self._entries = collections.OrderedDict()
+        self._pinned = {}
+        self._size = 0
+        # Map from (project, key) to 'AsyncResult' of the entries being loaded by
+        # 'get_or_load'
+        self._loading = {}
+        # Number of times each project's entries have been cleared or revalidated
+        self._generations = collections.Counter()
         self._lock = threading.Lock()
+        # Statistics since process start: "hits", "misses", "evictions",
+        # "evicted_bytes", "loads", "coalesced" (misses that waited for a load already
+        # in progress, instead of loading the entry again), "revalidations" (entries
+        # reloaded in the background because their data changed) and
+        # "revalidation_failures"
+        self.stats = collections.Counter()
 
-    def get(self, project, key):
+    def get_or_load(self, project, key, load, pinned=False):
+        """
+        Return the value for 'project' and 'key'; if it is not in the cache, call
+        'load()' to get it, and put it in the cache. Concurrent calls for the same
+        missing entry (e.g. a burst of requests for a page just after the cache was
+        cleared) wait for the first one's 'load()' and share its result, or exception.
+        'load' is also used to reload the entry when its data changes.
+        """
         with self._lock:
-            return self._cache.get(project, {}).get(key)
+            if (value := self._get((project, key))) is not None:
+                return value
+            if (loading := self._loading.get((project, key))) is not None:
+                self.stats["coalesced"] += 1
+                is_loader = False
+            else:
+                loading = self._loading[(project, key)] = gevent.event.AsyncResult()
+                generation = self._generations[project]
+                self.stats["loads"] += 1
+                is_loader = True
+        if not is_loader:
+            return loading.get()
+        try:
+            value = load()
+        except BaseException as e:
+            loading.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                if self._loading.get((project, key)) is loading:
+                    del self._loading[(project, key)]
+        self._put_if_current(project, key, value, pinned, load, generation)
+        loading.set(value)
+        return value
 
-    def put(self, project, key, value):
+    def clear(self, project):
         with self._lock:
-            logging.info("writing %s:%s to inproc cache", project, key)
-            self._cache.setdefault(project, {})[key] = value
+            self._new_generation(project)
+            for entries in (self._entries, self._pinned):
+                for project_key in [pk for pk in entries if pk[0] == project]:
+                    self._remove(project_key)
 
-    def clear(self, project):
+    def revalidate(self, project, is_stale):
+        """
+        Reload the entries of 'project' whose key 'is_stale(key)' is true, in the
+        background; until each one is reloaded, its stale value is still served.
+        """
+        with self._lock:
+            generation = self._new_generation(project)
+            reloads = []
+            for entries, pinned in ((self._entries, False), (self._pinned, True)):
+                for project_key, (_, _, load) in entries.items():
+                    if project_key[0] == project and is_stale(project_key[1]):
+                        reloads.append((project_key, load, pinned))
+        logging.info("revalidating %d %s inproc cache entries", len(reloads), project)
+        pool = gevent.pool.Pool(_REVALIDATE_CONCURRENCY)
+        for (_, key), load, pinned in reloads:
+            pool.spawn(self._reload, project, key, load, pinned, generation)
+
+    def info(self):
+        """
+        Return a dict of the current state of the cache and its statistics.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries) + len(self._pinned),
+                "pinned_entries": len(self._pinned),
+                "bytes": self._size,
+                "pinned_bytes": sum(entry[1] for entry in self._pinned.values()),
+                "max_bytes": self._max_bytes,
+                **self.stats,
+            }
+
+    def export_metrics(self):
+        """
+        Export the size and the statistics of the cache, and the size of the shared
+        store, as metrics (hits and misses are counted by project separately).
+        """
+        metrics.Gauge(
+            "vimhelp_cache_bytes",
+            "Approximate memory used by the in-process cache entries",
+            collect=lambda: {(): self.info()["bytes"]},
+        )
+        metrics.Gauge(
+            "vimhelp_cache_entries",
+            "Number of entries in the in-process cache",
+            collect=lambda: {(): self.info()["entries"]},
+        )
+        metrics.Counter(
+            "vimhelp_cache_events_total",
+            "In-process cache events (loads, coalesced, evictions, evicted_bytes, "
+            "revalidations, revalidation_failures; see 'Cache.stats')",
+            ("event",),
+            collect=lambda: {
+                (event,): n
+                for event, n in self.stats.items()
+                if event not in ("hits", "misses")
+            },
+        )
+        if self.shared_store is not None:
+            metrics.Gauge(
+                "vimhelp_shared_store_bytes",
+                "Bytes used in the current shared store file of each project",
+                ("project",),
+                collect=lambda: {
+                    (project,): used
+                    for project, used in self.shared_store.info().items()
+                },
+            )
+
+    def _reload(self, project, key, load, pinned, generation):
+        try:
+            value = load()
+        except Exception:
+            # E.g. the file no longer exists. Either way, the next request for it will
+            # try to load it.
+            logging.exception("failed to reload %s:%s", project, key)
+            with self._lock:
+                self.stats["revalidation_failures"] += 1
+                if self._generations[project] == generation:
+                    self._remove((project, key))
+            return
+        with self._lock:
+            self.stats["revalidations"] += 1
+        self._put_if_current(project, key, value, pinned, load, generation)
+
+    def _put_if_current(self, project, key, value, pinned, load, generation):
+        # If the project's entries were cleared or revalidated since 'value' started
+        # loading, it may be out of date already, so don't keep it.
         with self._lock:
-            if c := self._cache.get(project):
-                c.clear()
+            if self._generations[project] == generation:
+                self._put((project, key), value, pinned, load)
+
+    def _new_generation(self, project):
+        # Must be called with the lock held. Later misses start loading afresh rather
+        # than wait for the loads in progress.
+        for project_key in [pk for pk in self._loading if pk[0] == project]:
+            del self._loading[project_key]
+        self._generations[project] += 1
+        return self._generations[project]
+
+    def _get(self, project_key):
+        # Must be called with the lock held
+        entry = self._pinned.get(project_key)
+        if entry is None:
+            entry = self._entries.get(project_key)
+            if entry is None:
+                self.stats["misses"] += 1
+                _LOOKUPS.inc(project_key[0], "miss")
+                return None
+            self._entries.move_to_end(project_key)
+        self.stats["hits"] += 1
+        _LOOKUPS.inc(project_key[0], "hit")
+        return entry[0]
+
+    def _put(self, project_key, value, pinned, load):
+        # Must be called with the lock held. The size is measured up front; objects that
+        # grow afterwards (like the tag search index's query cache) need to keep that
+        # bounded themselves.
+        size = sizeof(value)
+        metrics.debug_sampled(
+            "writing %s:%s (%d bytes%s) to inproc cache",
+            *project_key,
+            size,
+            ", pinned" if pinned else "",
+        )
+        self._remove(project_key)
+        if pinned:
+            self._pinned[project_key] = (value, size, load)
+        else:
+            self._entries[project_key] = (value, size, load)
+        self._size += size
+        while self._size > self._max_bytes and self._entries:
+            old_project_key, (_, old_size, _) = self._entries.popitem(last=False)
+            self._size -= old_size
+            self.stats["evictions"] += 1
+            self.stats["evicted_bytes"] += old_size
+            metrics.debug_sampled(
+                "evicted %s:%s (%d bytes) from inproc cache",
+                *old_project_key,
+                old_size,
+            )
+
+    def _remove(self, project_key):
+        # Must be called with the lock held
+        entry = self._entries.pop(project_key, None)
+        if entry is None:
+            entry = self._pinned.pop(project_key, None)
+        if entry is not None:
+            self._size -= entry[1]
 
     def start_refresh_loop(self, warmup_callback):
-        update_times = Cache._get_update_times()
+        global_infos = Cache._get_global_infos()
+        if self.shared_store is not None:
+            for project, g in global_infos.items():
+                self._switch_store_generation(project, g, None)
         gevent.spawn_later(
-            _REFRESH_INTERVAL_SEC, self._refresh, update_times, warmup_callback
+            _REFRESH_INTERVAL_SEC, self._refresh, global_infos, warmup_callback
         )
 
-    def _refresh(self, old_update_times, warmup_callback):
-        update_times = Cache._get_update_times()
-        for project, update_time in update_times.items():
-            old_update_time = old_update_times.get(project)
-            if old_update_time is None or update_time > old_update_time:
+    def _refresh(self, old_global_infos, warmup_callback):
+        global_infos = Cache._get_global_infos()
+        for project, g in global_infos.items():
+            old_g = old_global_infos.get(project)
+            old_update_time = old_g.last_update_time if old_g is not None else None
+            if old_update_time is not None and g.last_update_time <= old_update_time:
                 logging.info(
-                    "project %s was updated (%s < %s), refreshing cache",
-                    project,
-                    old_update_time,
-                    update_time,
+                    "project %s was not updated, not refreshing cache", project
                 )
+                continue
+            logging.info(
+                "project %s was updated (%s < %s), refreshing cache",
+                project,
+                old_update_time,
+                g.last_update_time,
+            )
+            if old_g is None or old_g.cache_etags is None or g.cache_etags is None:
+                # No way of telling what changed
+                is_stale = None
+            else:
+                is_stale = _stale_key_checker(old_g.cache_etags, g.cache_etags)
+            if self.shared_store is not None:
+                is_stale = self._switch_store_generation(project, g, is_stale)
+            if is_stale is None:
                 self.clear(project)
-                warmup_callback(project)
             else:
-                logging.info(
-                    "project %s was not updated, not refreshing cache", project
-                )
+                self.revalidate(project, is_stale)
+            warmup_callback(project)
+        logging.info("inproc cache: %s", self.info())
+        if self.shared_store is not None:
+            logging.info("shared store bytes used: %s", self.shared_store.info())
         gevent.spawn_later(
-            _REFRESH_INTERVAL_SEC, self._refresh, update_times, warmup_callback
+            _REFRESH_INTERVAL_SEC, self._refresh, global_infos, warmup_callback
+        )
+
+    def _switch_store_generation(self, project, g, is_stale):
+        # Switch the shared store to the project's new generation, which gets the
+        # records of the unchanged entries of the old one. The entries that were loaded
+        # from the old one are then stale too: reloading them from the new one is cheap,
+        # and lets the old one be freed.
+        if g.last_update_time is None:
+            return is_stale
+        keep = None if is_stale is None else lambda key: not is_stale(key)
+        old_keys = self.shared_store.switch_generation(
+            project, g.last_update_time.strftime("%Y%m%d%H%M%S%f"), keep
         )
+        if is_stale is None:
+            return None
+        return lambda key: is_stale(key) or key in old_keys
 
     @staticmethod
-    def _get_update_times():
+    def _get_global_infos():
         with ndb_context():
-            return {g.key.id(): g.last_update_time for g in GlobalInfo.query()}
+            return {g.key.id(): g for g in GlobalInfo.query()}
+
+
+def _stale_key_checker(old_etags, etags):
+    # Keys that the updater has not recorded an ETag for may have changed.
+    return lambda key: key not in etags or etags[key] != old_etags.get(key)
+
+
+def sizeof(obj):
+    """
+    Return the approximate number of bytes of memory used by 'obj' and everything it
+    refers to (counting objects that are referred to more than once only once), going
+    into containers and the attributes of instances, but not into classes, functions
+    etc., which are not part of the data.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        # Most objects are strings etc. in containers, so check for those first.
+        if type(obj) in _ATOMIC_TYPES:
+            continue
+        if isinstance(obj, dict):
+            stack += obj.keys()
+            stack += obj.values()
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack += obj
+        elif isinstance(obj, memoryview):
+            stack.append(obj.obj)
+        elif hasattr(obj, "__dict__") and not isinstance(obj, _OPAQUE_TYPES):
+            stack.append(vars(obj))
+    return size
+
+
+_ATOMIC_TYPES = frozenset((str, bytes, int, float, bool, type(None)))
+_OPAQUE_TYPES = (type, type(sys), type(sizeof), type(len))
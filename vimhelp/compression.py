@@ -0,0 +1,101 @@
+# Gzip compression of processed files. The bulk of each page is compressed ahead of
+# time, and combined with the (separately compressed) prelude on demand.
+
+import functools
+import struct
+import zlib
+
+
+# Header of a gzip member without file name, modification time etc. (RFC 1952)
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+_CRC32_POLY = 0xEDB88320
+
+
+class Deflater:
+    """
+    Incrementally compresses data into a raw DEFLATE stream (RFC 1951), keeping track
+    of the CRC-32 and size of the uncompressed data, as needed for the gzip trailer.
+    """
+
+    def __init__(self):
+        self._compressobj = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._chunks = []
+        self.crc32 = 0
+        self.size = 0
+
+    def update(self, data):
+        self._chunks.append(self._compressobj.compress(data))
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.size += len(data)
+
+    def finish(self):
+        self._chunks.append(self._compressobj.flush())
+        return b"".join(self._chunks)
+
+
+def gzip_chunks(prelude, body, body_crc32, body_size):
+    """
+    Return the pieces of a gzip member containing 'prelude' (bytes) followed by the
+    data that was compressed by a 'Deflater' into 'body', with the given CRC-32 and
+    size.
+    """
+    prelude_deflated, prelude_crc32 = _deflate_prelude(prelude)
+    # The prelude's DEFLATE blocks end with a sync flush, i.e. byte-aligned and not
+    # final, so the body's blocks can follow on directly; since the body was
+    # compressed on its own, it never refers back into the prelude.
+    crc32 = crc32_combine(prelude_crc32, body_crc32, body_size)
+    size = (len(prelude) + body_size) & 0xFFFFFFFF
+    trailer = struct.pack("<II", crc32, size)
+    return GZIP_HEADER, prelude_deflated, body, trailer
+
+
+@functools.cache
+def _deflate_prelude(prelude):
+    compressobj = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressobj.compress(prelude) + compressobj.flush(zlib.Z_SYNC_FLUSH)
+    return deflated, zlib.crc32(prelude)
+
+
+def crc32_combine(crc1, crc2, len2):
+    """
+    Given the CRC-32s of two byte strings, and the length of the second one, return
+    the CRC-32 of their concatenation (like zlib's function of the same name, which
+    Python's zlib module does not expose).
+    """
+    return _crc32_multmodp(_crc32_x2nmodp(len2, 3), crc1) ^ crc2
+
+
+def _crc32_multmodp(a, b):
+    # Multiply polynomials a and b modulo the CRC-32 polynomial
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m - 1)) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ _CRC32_POLY if b & 1 else b >> 1
+    return p
+
+
+def _crc32_x2nmodp(n, k):
+    # Return x^(n * 2^k) modulo the CRC-32 polynomial
+    p = 1 << 31
+    while n:
+        if n & 1:
+            p = _crc32_multmodp(_CRC32_X2N_TABLE[k & 31], p)
+        n >>= 1
+        k += 1
+    return p
+
+
+def _make_crc32_x2n_table():
+    table = [1 << 30]
+    for _ in range(31):
+        table.append(_crc32_multmodp(table[-1], table[-1]))
+    return table
+
+
+_CRC32_X2N_TABLE = _make_crc32_x2n_table()
@@ -32,12 +32,49 @@ class GlobalInfo(ndb.Model):
     last_update_time = ndb.DateTimeProperty(indexed=False)
     # Time of last changes to generated files
 
+    cache_etags = ndb.JsonProperty(json_type=dict, compressed=True)
+    # Map from key in the web app's in-process cache (see cache.py), i.e. processed file
+    # name or search index cache key ID, to ETag of the generated data it is loaded
+    # from; used to tell which cached entries are out of date after an update
+
+    tags_source_etags = ndb.JsonProperty(json_type=dict)
+    # Map from name (tags file and FAQ) to HTTP ETag of the raw file that the saved tags
+    # ('TagsInfo') were built from; only saved once all the files affected by changes
+    # in the tags have been translated again, so that a failed update is retried
+
 
 # Tags, for use with the "go to tag" feature; key name is "vim" or "neovim".
 class TagsInfo(ndb.Model):
-    tags = ndb.JsonProperty(json_type=list)
+    tags = ndb.JsonProperty(json_type=list, compressed=True)
     # Map from vimhelp tag to (site-relative) link. Looks like this:
     # [ ["t": "motion.txt#t"], ["perl": "if_perl.txt#perl"], ... ]
+    # (Entities written by older versions have it uncompressed, which reads the same.)
+
+    index = ndb.BlobProperty()
+    # The tag search index built from 'tags', ready to be loaded (see
+    # 'tagsearch.TagIndex.to_bytes'); not present in entities written by older
+    # versions, nor if it would not have fit
+
+
+# The same tags, as the index for client-side tag search (see tagindex.py); key name is
+# "vim" or "neovim".
+class ClientTagIndex(ndb.Model):
+    index = ndb.JsonProperty(json_type=dict, compressed=True)
+    # The index (see 'tagindex.build_index')
+
+    hash = ndb.TextProperty()
+    # Hash of the encoded index, which is part of its URL
+
+
+# The most requested pages of a project, as last saved by a web app process, so that new
+# processes know which pages to load in advance (see 'vimhelp.prewarm'); key name is
+# "vim" or "neovim".
+class HotPages(ndb.Model):
+    filenames = ndb.JsonProperty(json_type=list)
+    # Names of the processed files, most requested first
+
+    modified = ndb.DateTimeProperty(indexed=False, auto_now=True)
+    # Time when this was saved
 
 
 # Info related to an unprocessed documentation file from the repository; key name is
@@ -90,6 +127,22 @@ class ProcessedFileHead(ndb.Model):
     # Contents of the first (and possibly only) part
 
 
+# The set of tags that were looked up while translating a processed file (whether or not
+# they resolved to a link); key name is e.g. "vim:faq.txt" or "neovim:help.txt".
+# When the tags change, only files that reference an added, removed or retargeted tag
+# need to be translated again.
+class ProcessedFileRefs(ndb.Model):
+    project = ndb.StringProperty(required=True)
+    # Either "vim" or "neovim", always matches the entity key ID
+
+    tags = ndb.JsonProperty(json_type=list, compressed=True)
+    # Sorted list of tags
+
+    cache_key = ndb.BlobProperty()
+    # Hash of all inputs to the translation (see 'VimH2H.cache_key'); if it is
+    # unchanged, the existing 'ProcessedFileHead' and parts are reused as they are
+
+
 # Part of a processed file; keyname is "{project}:{basename}:{partnum}", e.g.
 # "neovim:help.txt:1".
 # This chunking is necessary because the maximum entity size in the Datastore is 1 MB:
@@ -105,3 +158,63 @@ class ProcessedFilePart(ndb.Model):
     # Same value as corresponding 'ProcessedFileHead.etag'. Used when retrieving the
     # 'ProcessedFileHead' and all its 'ProcessedFilePart's to ensure that they were
     # retrieved consistently.
+
+
+# Gzip-compressed variant of a processed file, excluding the prelude; key name is the
+# same as that of the corresponding 'ProcessedFileHead'. Not present if the compressed
+# data would not fit into a single entity.
+class ProcessedFileGzip(ndb.Model):
+    data = ndb.BlobProperty(required=True)
+    # Raw DEFLATE stream of the contents of the 'ProcessedFileHead' and its
+    # 'ProcessedFilePart's; see compression.py
+
+    crc32 = ndb.IntegerProperty(indexed=False, required=True)
+    # CRC-32 of the uncompressed contents
+
+    size = ndb.IntegerProperty(indexed=False, required=True)
+    # Length of the uncompressed contents
+
+    etag = ndb.BlobProperty(required=True)
+    # Same value as corresponding 'ProcessedFileHead.etag'. If it differs, this is left
+    # over from an earlier translation, and must not be used.
+
+
+# Search terms of a documentation file, extracted from the raw file for full-text search
+# (see fulltext.py); key name is e.g. "vim:help.txt" or "neovim:api.txt"
+class SearchTerms(ndb.Model):
+    project = ndb.StringProperty(required=True)
+    # Either "vim" or "neovim", always matches the entity key ID
+
+    content_hash = ndb.BlobProperty(required=True)
+    # SHA-1 of the raw file that the terms were extracted from
+
+    terms = ndb.JsonProperty(json_type=dict, compressed=True)
+    # Map from term to list of number of occurrences and (some) line numbers
+
+    anchors = ndb.JsonProperty(json_type=list, compressed=True)
+    # List of [line number, tag] pairs of the tags defined in the file
+
+    length = ndb.IntegerProperty(indexed=False)
+    # Total number of terms
+
+
+# Full-text search index of all files, built from their 'SearchTerms' at the end of an
+# update; key name is "vim" or "neovim". Split into parts like a processed file.
+class SearchIndexHead(ndb.Model):
+    etag = ndb.BlobProperty(required=True)
+    # Hash of the contents
+
+    numparts = ndb.IntegerProperty(indexed=False)
+    # Number of parts; there will be 'numparts - 1' objects of kind 'SearchIndexPart'
+
+    data0 = ndb.BlobProperty(required=True)
+    # Contents of the first (and possibly only) part (see 'SearchIndex.to_bytes')
+
+
+# Part of a full-text search index; key name is "{project}:{partnum}", e.g. "vim:1"
+class SearchIndexPart(ndb.Model):
+    data = ndb.BlobProperty(required=True)
+    # Contents
+
+    etag = ndb.BlobProperty(required=True)
+    # Same value as corresponding 'SearchIndexHead.etag'
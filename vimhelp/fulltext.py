@@ -0,0 +1,265 @@
+# Full-text search of the help files. The terms of each file are extracted when it is
+# translated, and merged into an inverted index of the whole project at the end of each
+# update (see update.py), which is stored in the Datastore in parts. '/api/search'
+# answers queries from an in-memory copy of it.
+
+import array
+import bisect
+import heapq
+import json
+import math
+import re
+import zlib
+
+import flask
+import werkzeug.exceptions
+
+from . import dbmodel
+from . import packing
+from . import vimh2h
+from . import vimhelp
+
+
+CACHE_KEY_ID = "api/search-index"
+
+MAX_RESULTS = 20
+
+# Maximum number of snippets (matching lines) per result
+MAX_SNIPPETS = 3
+
+# Number of lines kept per term and file: enough to find lines where several terms of a
+# query occur together, without storing every occurrence of common words
+MAX_LINES_PER_TERM = 16
+
+# Terms are runs of at least two word characters, compared case-insensitively
+RE_TERM = re.compile(r"\w{2,}")
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# How long browsers and proxies may cache responses
+MAX_AGE = 15 * 60
+
+_FORMAT_MAGIC = b"VHS1"
+
+
+def extract_terms(contents):
+    """
+    Extract the search terms from the help file 'contents'. Return a '(terms, anchors,
+    length)' tuple: a dict mapping each term to a list of its number of occurrences
+    followed by (up to MAX_LINES_PER_TERM of) the numbers of the lines it occurs on; a
+    list of '[line number, tag]' pairs for the tags defined in the file; and the total
+    number of terms. Line numbers start at 1.
+    """
+    terms = {}
+    length = 0
+    for lineno, line in enumerate(vimh2h.RE_NEWLINE.split(vimh2h.to_str(contents)), 1):
+        for term in RE_TERM.findall(line.casefold()):
+            length += 1
+            if (entry := terms.get(term)) is None:
+                terms[term] = [1, lineno]
+            else:
+                entry[0] += 1
+                if entry[-1] != lineno and len(entry) <= MAX_LINES_PER_TERM:
+                    entry.append(lineno)
+    anchors = [[lineno, tag] for lineno, tag in vimh2h.tag_definitions(contents)]
+    return terms, anchors, length
+
+
+class SearchIndex:
+    """
+    Inverted index of the help files of a project. Terms are sorted; the postings of
+    each term, i.e. the files it occurs in (in ascending order), the number of
+    occurrences in each, and the lines it occurs on, are stored in arrays, in the
+    manner of a CSR sparse matrix.
+    """
+
+    def __init__(self, docs, terms, arrays):
+        # 'docs' is a list of '(filename, href, length, anchor_lines, anchor_hrefs)'
+        self.docs = docs
+        self.terms = terms
+        (
+            self._term_offsets,
+            self._post_docs,
+            self._post_counts,
+            self._line_offsets,
+            self._lines,
+        ) = arrays
+        self._avg_length = sum(doc[2] for doc in docs) / max(len(docs), 1)
+
+    @classmethod
+    def build(cls, files):
+        """
+        Build the index from 'files', a list of '(filename, htmlfilename, terms,
+        anchors, length)' tuples, where the last three items are as returned by
+        'extract_terms'.
+        """
+        files = sorted(files)
+        docs = []
+        postings = {}
+        for doc_id, file in enumerate(files):
+            filename, htmlfilename, terms, anchors, length = file
+            link = (filename, htmlfilename)
+            anchors = sorted(anchors)
+            docs.append(
+                (
+                    filename,
+                    htmlfilename,
+                    length,
+                    array.array("I", (lineno for lineno, _ in anchors)),
+                    [vimh2h.link_href(tag, link, False) for _, tag in anchors],
+                )
+            )
+            for term, entry in terms.items():
+                postings.setdefault(term, []).append((doc_id, entry))
+        sorted_terms = sorted(postings)
+        term_offsets = array.array("I", [0])
+        post_docs = array.array("I")
+        post_counts = array.array("I")
+        line_offsets = array.array("I", [0])
+        lines = array.array("I")
+        for term in sorted_terms:
+            for doc_id, entry in postings[term]:
+                post_docs.append(doc_id)
+                post_counts.append(entry[0])
+                lines.extend(entry[1:])
+                line_offsets.append(len(lines))
+            term_offsets.append(len(post_docs))
+        arrays = (term_offsets, post_docs, post_counts, line_offsets, lines)
+        return cls(docs, sorted_terms, arrays)
+
+    def to_bytes(self):
+        header = {
+            "docs": [
+                [filename, href, length, list(anchor_lines), anchor_hrefs]
+                for filename, href, length, anchor_lines, anchor_hrefs in self.docs
+            ],
+            "terms": self.terms,
+        }
+        chunks = [_FORMAT_MAGIC, packing.pack_blob(json.dumps(header).encode())]
+        chunks += map(packing.pack_array, self._arrays())
+        return zlib.compress(b"".join(chunks))
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = memoryview(zlib.decompress(data))
+        if data[: len(_FORMAT_MAGIC)] != _FORMAT_MAGIC:
+            raise ValueError("bad search index format")
+        pos = len(_FORMAT_MAGIC)
+        header, pos = packing.unpack_blob(data, pos)
+        header = json.loads(bytes(header))
+        arrays = []
+        for _ in range(5):
+            arr, pos = packing.unpack_array(data, pos, "I")
+            arrays.append(arr)
+        docs = [
+            (filename, href, length, array.array("I", anchor_lines), anchor_hrefs)
+            for filename, href, length, anchor_lines, anchor_hrefs in header["docs"]
+        ]
+        return cls(docs, header["terms"], arrays)
+
+    def _arrays(self):
+        return (
+            self._term_offsets,
+            self._post_docs,
+            self._post_counts,
+            self._line_offsets,
+            self._lines,
+        )
+
+    def search(self, query, max_results=MAX_RESULTS):
+        """
+        Return up to 'max_results' of the files containing all the terms in 'query',
+        best matches first (ranked by BM25), as a list of dicts of the form
+        {"file": ..., "href": ..., "score": ..., "snippets": [{"line": ..., "href":
+        ...}, ...]}, where each snippet is a line where as many of the terms as
+        possible occur, and the href is that of the nearest tag defined above it.
+        """
+        query_terms = set(RE_TERM.findall(query.casefold()))
+        if not query_terms:
+            return []
+        ranges = []
+        for term in query_terms:
+            i = bisect.bisect_left(self.terms, term)
+            if i == len(self.terms) or self.terms[i] != term:
+                return []
+            ranges.append((self._term_offsets[i], self._term_offsets[i + 1]))
+        # Start with the rarest term, which limits the candidates the most.
+        ranges.sort(key=lambda r: r[1] - r[0])
+
+        num_docs = len(self.docs)
+        scores = None
+        doc_postings = {}
+        for lo, hi in ranges:
+            df = hi - lo
+            idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            new_scores = {}
+            for p in range(lo, hi):
+                doc_id = self._post_docs[p]
+                if scores is not None and doc_id not in scores:
+                    continue
+                tf = self._post_counts[p]
+                norm = 1 - BM25_B + BM25_B * self.docs[doc_id][2] / self._avg_length
+                score = idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+                new_scores[doc_id] = (scores[doc_id] if scores else 0) + score
+                doc_postings.setdefault(doc_id, []).append(p)
+            scores = new_scores
+            if not scores:
+                return []
+
+        best = heapq.nlargest(max_results, scores.items(), key=lambda item: item[1])
+        return [
+            {
+                "file": self.docs[doc_id][0],
+                "href": self.docs[doc_id][1],
+                "score": round(score, 3),
+                "snippets": self._snippets(doc_id, doc_postings[doc_id]),
+            }
+            for doc_id, score in best
+        ]
+
+    def _snippets(self, doc_id, postings):
+        # The lines where most of the terms occur, among the (first few) lines of each
+        # term, breaking ties by line number
+        line_counts = {}
+        for p in postings:
+            for i in range(self._line_offsets[p], self._line_offsets[p + 1]):
+                lineno = self._lines[i]
+                line_counts[lineno] = line_counts.get(lineno, 0) + 1
+        lines = sorted(line_counts, key=lambda lineno: (-line_counts[lineno], lineno))
+        _, href, _, anchor_lines, anchor_hrefs = self.docs[doc_id]
+        snippets = []
+        for lineno in sorted(lines[:MAX_SNIPPETS]):
+            i = bisect.bisect_right(anchor_lines, lineno)
+            snippets.append(
+                {"line": lineno, "href": anchor_hrefs[i - 1] if i > 0 else href}
+            )
+        return snippets
+
+
+def handle_search(cache):
+    index = get_index(cache)
+    query = flask.request.args.get("q", "")
+    resp = flask.jsonify({"results": index.search(query)})
+    resp.cache_control.public = True
+    resp.cache_control.max_age = MAX_AGE
+    return resp
+
+
+def get_index(cache):
+    project = flask.g.project
+    return cache.get_or_load(project, CACHE_KEY_ID, lambda: load_index(project))
+
+
+def load_index(project):
+    with dbmodel.ndb_context():
+        head = dbmodel.SearchIndexHead.get_by_id(project)
+        if head is None:
+            raise werkzeug.exceptions.NotFound()
+        return SearchIndex.from_bytes(get_data(head))
+
+
+def get_data(head):
+    parts = vimhelp.get_parts(head, "SearchIndexPart")
+    return b"".join((head.data0, *(p.data for p in parts)))
@@ -0,0 +1,205 @@
+# Metrics of the web app (cache hits and misses, datastore fetch latency etc.), exposed
+# in the Prometheus text format at /_admin/metrics (see webapp.py). Like the in-process
+# cache, they are kept per process, and start afresh with each one.
+
+import abc
+import bisect
+import collections
+import contextlib
+import logging
+import math
+import os
+import time
+
+import flask
+import werkzeug.exceptions
+
+
+# Upper bounds of the buckets of latency histograms, in seconds
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+# Messages logged on the hot path (see 'debug_sampled') are only logged one time in
+# every LOG_SAMPLE_RATE
+LOG_SAMPLE_RATE = 100
+
+_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Map from name to metric, in order of creation
+_registry = {}
+
+# Number of calls to 'debug_sampled' for each message
+_log_counts = collections.Counter()
+
+
+class _Metric(abc.ABC):
+    kind = None
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _registry[name] = self
+
+    @abc.abstractmethod
+    def samples(self):
+        """
+        Yield the '(name suffix, labels dict, value)' of each sample of the metric.
+        """
+
+
+class Counter(_Metric):
+    """
+    A counter with a value for each combination of values of 'labels'. If 'collect' is
+    given, the values are not counted here, but got by calling it whenever the metrics
+    are rendered; it must return a dict mapping tuples of label values to values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self._collect = collect
+        self._values = collections.Counter()
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] += amount
+
+    def samples(self):
+        values = self._collect() if self._collect is not None else self._values
+        for label_values, value in values.items():
+            yield "", dict(zip(self.labels, label_values)), value
+
+
+class Gauge(Counter):
+    """
+    Like 'Counter', but for values that can go down as well as up; 'collect' is
+    required.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), *, collect):
+        super().__init__(name, help, labels, collect)
+
+
+class Histogram(_Metric):
+    """
+    A histogram of observed values (e.g. latencies, in seconds) for each combination
+    of values of 'labels', counted in buckets with the upper bounds 'buckets'.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self._buckets = buckets
+        # Map from tuple of label values to list of the number of values in each bucket
+        # (not cumulative, with one more for those above the last bound), followed by
+        # their sum
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        if (entry := self._values.get(label_values)) is None:
+            entry = self._values[label_values] = [0] * (len(self._buckets) + 2)
+        entry[bisect.bisect_left(self._buckets, value)] += 1
+        entry[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        """
+        Observe the time taken by the body of the 'with' statement.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self):
+        for label_values, entry in self._values.items():
+            labels = dict(zip(self.labels, label_values))
+            count = 0
+            for bound, n in zip((*self._buckets, math.inf), entry):
+                count += n
+                yield "_bucket", {**labels, "le": _format_value(bound)}, count
+            yield "_sum", labels, entry[-1]
+            yield "_count", labels, count
+
+
+def render():
+    """
+    Return all the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            if labels:
+                label_str = ",".join(
+                    f'{name}="{_escape(label_value)}"'
+                    for name, label_value in labels.items()
+                )
+                lines.append(
+                    f"{metric.name}{suffix}{{{label_str}}} {_format_value(value)}"
+                )
+            else:
+                lines.append(f"{metric.name}{suffix} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def handle_metrics():
+    # Imported here, so that the rest of the app (and the scripts, via the modules that
+    # record metrics) do not need the secrets.
+    from . import secret
+
+    req = flask.request
+    if (
+        os.environ.get("VIMHELP_ENV") != "dev"
+        and secret.UPDATE_PASSWORD not in req.query_string
+    ):
+        raise werkzeug.exceptions.Forbidden()
+    return flask.Response(render(), content_type=_CONTENT_TYPE)
+
+
+def debug_sampled(msg, *args):
+    """
+    Log 'msg' (a format string, like for 'logging.debug') at DEBUG level, if that is
+    enabled, the first time and then one time in every LOG_SAMPLE_RATE; for messages
+    on the hot path, which would otherwise cost more than they are worth.
+    """
+    if not logging.root.isEnabledFor(logging.DEBUG):
+        return
+    n = _log_counts[msg]
+    _log_counts[msg] = n + 1
+    if n % LOG_SAMPLE_RATE == 0:
+        logging.debug(msg + " (logged 1 in %d)", *args, LOG_SAMPLE_RATE)
+
+
+def _escape(label_value):
+    return (
+        str(label_value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    )
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,41 @@
+# Building blocks of the binary formats in which the search indexes are stored (see
+# 'tagsearch.TagIndex.to_bytes' and 'fulltext.SearchIndex.to_bytes'): length-prefixed
+# blobs, and arrays of integers, which are stored little-endian.
+
+import array
+import struct
+import sys
+
+
+def pack_blob(blob):
+    return struct.pack("<I", len(blob)) + blob
+
+
+def unpack_blob(data, pos):
+    """
+    Return the blob packed at 'pos' in 'data', as a slice of it, and the position after
+    it.
+    """
+    (length,) = struct.unpack_from("<I", data, pos)
+    pos += 4
+    return data[pos : pos + length], pos + length
+
+
+def pack_array(arr):
+    if sys.byteorder != "little":
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+    return pack_blob(arr.tobytes())
+
+
+def unpack_array(data, pos, typecode):
+    """
+    Return the array of type 'typecode' packed at 'pos' in 'data', and the position
+    after it.
+    """
+    blob, pos = unpack_blob(data, pos)
+    arr = array.array(typecode)
+    arr.frombytes(blob)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr, pos
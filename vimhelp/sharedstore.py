@@ -0,0 +1,337 @@
+# Store of prebuilt pages in memory-mapped files, shared by all the processes (i.e.
+# gunicorn workers) of an instance, so that however many of them serve a page, there is
+# only one copy of it in memory. It is used if the VIMHELP_SHARED_STORE_DIR environment
+# variable is set, to a directory in a RAM-backed file system (such as /tmp on App
+# Engine); see webapp.py, cache.py and vimhelp.py.
+#
+# Each project has a store file per generation, i.e. per update of the project. A store
+# file is created at its full capacity (as a sparse file), with a header giving the
+# number of bytes used so far, followed by records, which are appended by any process
+# holding an exclusive lock on the file, and never changed or removed. Each process
+# keeps its own (small) index of the records, and catches up with those of the other
+# processes when it looks up a key it does not know. When a project is updated, every
+# process switches to the new generation's file; the first one to do so creates it, with
+# the unchanged records of the old one copied over, and the old one is removed (its
+# memory is freed once no process maps it any more).
+#
+# Pages are served straight from the store files where possible: see 'open_range'.
+
+import contextlib
+import fcntl
+import json
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import tempfile
+
+
+# Default capacity of a store file; can be overridden with the
+# VIMHELP_SHARED_STORE_MAX_BYTES environment variable (see webapp.py)
+DEFAULT_CAPACITY = 256 * 1024 * 1024
+
+_FORMAT_MAGIC = b"VHP1"
+
+_SUFFIX = ".store"
+
+# Magic, number of bytes used (including the header)
+_HEADER = struct.Struct("<4s4xQ")
+
+# Length of the record (including this header), length of the key, length of the
+# metadata; followed by the key, the metadata (JSON) and the blobs
+_RECORD = struct.Struct("<III")
+
+
+class SharedStore:
+    """
+    The shared store files of all projects, in 'directory'.
+    """
+
+    def __init__(self, directory, capacity=DEFAULT_CAPACITY):
+        self._dir = pathlib.Path(directory)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._capacity = capacity
+        # Map from project to its current generation's 'StoreFile'
+        self._files = {}
+
+    def current(self, project):
+        """
+        Return the 'StoreFile' of the current generation of 'project', or None if there
+        is none.
+        """
+        return self._files.get(project)
+
+    def switch_generation(self, project, generation, keep=None):
+        """
+        Make 'generation' (a string that sorts after those of earlier generations) the
+        current generation of 'project'. If no other process has created its file yet,
+        create it, copying over the records of the previous generation whose key
+        'keep(key)' is true. Return the keys of the records of the previous generation,
+        whose values must be reloaded from the new one, for the old one to be freed.
+        """
+        old = self._files.get(project)
+        if old is not None and old.generation == generation:
+            return set()
+        path = self._dir / f"{project}-{generation}{_SUFFIX}"
+        try:
+            new = StoreFile.open(
+                path,
+                generation,
+                self._capacity,
+                old if keep is not None else None,
+                keep,
+            )
+        except (OSError, ValueError):
+            # Pages are then loaded into each process's own memory, as without a store.
+            logging.exception("failed to open shared store file %s", path)
+            new = None
+        if new is not None:
+            self._files[project] = new
+            logging.info("switched to shared store file %s", path)
+        else:
+            self._files.pop(project, None)
+        if old is None:
+            return set()
+        old_keys = old.keys()
+        old.close()
+        for old_path in self._dir.glob(f"{project}-*{_SUFFIX}"):
+            old_generation = old_path.name[len(project) + 1 : -len(_SUFFIX)]
+            if old_generation < generation:
+                logging.info("removing shared store file %s", old_path)
+                with contextlib.suppress(FileNotFoundError):
+                    old_path.unlink()
+        return old_keys
+
+    def info(self):
+        """
+        Return a dict of the number of bytes used in each project's current store file.
+        """
+        return {project: f.used() for project, f in self._files.items()}
+
+
+class StoreFile:
+    """
+    The store file of one generation of a project, mapped into memory. Records consist
+    of a key (string), metadata (a JSON-serializable dict) and a list of blobs (byte
+    strings), which are returned as read-only memoryviews of the file, together with
+    the offset of the first one in the file. The blobs are stored one after the other.
+    """
+
+    def __init__(self, path, generation, fd):
+        self.path = path
+        self.generation = generation
+        self._fd = fd
+        self._mmap = mmap.mmap(fd, 0)
+        self._view = memoryview(self._mmap).toreadonly()
+        # Map from key to the offset of its record, for the records up to '_scanned'
+        self._index = {}
+        self._scanned = _HEADER.size
+        self._full = False
+
+    @classmethod
+    def open(cls, path, generation, capacity, old=None, keep=None):
+        """
+        Open the store file at 'path', or create it (with a capacity of 'capacity'
+        bytes, and the records of 'old' whose key 'keep(key)' is true), unless another
+        process creates it first.
+        """
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            pass
+        else:
+            try:
+                f = cls(path, generation, fd)
+            except BaseException:
+                os.close(fd)
+                raise
+            f._check_magic()
+            return f
+        # The file is created under a temporary name, and only linked into place once it
+        # is complete, so no process ever sees it half initialised.
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=_SUFFIX, dir=path.parent)
+        try:
+            os.ftruncate(fd, capacity)
+            f = cls(path, generation, fd)
+            _HEADER.pack_into(f._mmap, 0, _FORMAT_MAGIC, _HEADER.size)
+            if old is not None:
+                f._copy_records(old, keep)
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                f.close()
+                return cls.open(path, generation, capacity)
+            logging.info("created shared store file %s", path)
+            return f
+        finally:
+            os.unlink(tmp_path)
+
+    def close(self):
+        # The mapping itself stays in place while the values got from it are in use, but
+        # no more records are looked up or added (by loads still in progress when the
+        # generation was switched).
+        os.close(self._fd)
+        self._fd = None
+
+    def get(self, key):
+        """
+        Return the '(metadata, blobs, offset)' of the record of 'key', or None if there
+        is none.
+        """
+        if self._fd is None:
+            return None
+        if key not in self._index:
+            with self._locked(fcntl.LOCK_SH):
+                self._catch_up()
+        pos = self._index.get(key)
+        return self._record(pos) if pos is not None else None
+
+    def put(self, key, metadata, blobs):
+        """
+        Add a record for 'key' (unless another process has done so meanwhile), and
+        return its '(metadata, blobs, offset)' like 'get'; or return None if the file
+        is full or closed.
+        """
+        if self._fd is None:
+            return None
+        key_data = key.encode()
+        metadata = dict(metadata, lengths=[len(blob) for blob in blobs])
+        metadata_data = json.dumps(metadata).encode()
+        length = (
+            _RECORD.size + len(key_data) + len(metadata_data) + sum(map(len, blobs))
+        )
+        # Nothing in here switches greenlets, so the lock, which is held by the process,
+        # also keeps out the other greenlets of this process.
+        with self._locked(fcntl.LOCK_EX):
+            self._catch_up()
+            if key not in self._index:
+                pos = self.used()
+                if pos + length > len(self._mmap):
+                    if not self._full:
+                        logging.warning("shared store file %s is full", self.path)
+                        self._full = True
+                    return None
+                _RECORD.pack_into(
+                    self._mmap, pos, length, len(key_data), len(metadata_data)
+                )
+                pos += _RECORD.size
+                for data in (key_data, metadata_data, *blobs):
+                    self._mmap[pos : pos + len(data)] = data
+                    pos += len(data)
+                # Only now is the record visible to the other processes.
+                _HEADER.pack_into(self._mmap, 0, _FORMAT_MAGIC, pos)
+                self._catch_up()
+        return self._record(self._index[key])
+
+    def keys(self):
+        with self._locked(fcntl.LOCK_SH):
+            self._catch_up()
+        return set(self._index)
+
+    def used(self):
+        return _HEADER.unpack_from(self._mmap, 0)[1]
+
+    def _record(self, pos):
+        _, key_len, metadata_len = _RECORD.unpack_from(self._mmap, pos)
+        pos += _RECORD.size + key_len
+        metadata = json.loads(bytes(self._view[pos : pos + metadata_len]))
+        pos += metadata_len
+        offset = pos
+        blobs = []
+        for length in metadata.pop("lengths"):
+            blobs.append(self._view[pos : pos + length])
+            pos += length
+        return metadata, blobs, offset
+
+    def _catch_up(self):
+        # Must be called with the lock held
+        used = self.used()
+        pos = self._scanned
+        while pos < used:
+            length, key_len, _ = _RECORD.unpack_from(self._mmap, pos)
+            start = pos + _RECORD.size
+            self._index[bytes(self._view[start : start + key_len]).decode()] = pos
+            pos += length
+        self._scanned = pos
+
+    def _copy_records(self, old, keep):
+        # Only called while the file is not yet visible to other processes
+        used = self.used()
+        with old._locked(fcntl.LOCK_SH):
+            old._catch_up()
+            for key, pos in old._index.items():
+                if not keep(key):
+                    continue
+                length, _, _ = _RECORD.unpack_from(old._mmap, pos)
+                if used + length > len(self._mmap):
+                    break
+                self._mmap[used : used + length] = old._view[pos : pos + length]
+                used += length
+        _HEADER.pack_into(self._mmap, 0, _FORMAT_MAGIC, used)
+        self._catch_up()
+        logging.info(
+            "copied %d record(s) from %s to %s", len(self._index), old.path, self.path
+        )
+
+    def _check_magic(self):
+        if len(self._mmap) < _HEADER.size or self._mmap[:4] != _FORMAT_MAGIC:
+            self.close()
+            raise ValueError(f"bad shared store file format: {self.path}")
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        fcntl.flock(self._fd, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+def open_range(path, offset, length):
+    """
+    Return a 'RangeFile' of 'length' bytes of the store file at 'path' from 'offset'
+    (e.g. of blobs got from its 'StoreFile'), or None if the file has been removed.
+    """
+    try:
+        f = open(path, "rb", buffering=0)
+    except FileNotFoundError:
+        return None
+    return RangeFile(f, offset, length)
+
+
+class RangeFile:
+    """
+    A read-only file-like object for 'length' bytes of the (unbuffered) file 'f' from
+    'offset', for a WSGI server's 'wsgi.file_wrapper'. Positions are those in 'f',
+    which starts at 'offset', so that a server that sends files with 'socket.sendfile'
+    (such as gunicorn, which sends as many bytes as the Content-Length of the response
+    from the current position) can do so; with a plain socket, that is done with
+    'os.sendfile', without copying the data, and with a gevent one, with 'read' and
+    'send', a block at a time.
+    """
+
+    def __init__(self, f, offset, length):
+        self._file = f
+        self._end = offset + length
+        self._pos = f.seek(offset)
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        self._pos = self._file.seek(pos, whence)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        remaining = self._end - self._pos
+        size = remaining if size < 0 else min(size, remaining)
+        data = os.pread(self._file.fileno(), size, self._pos)
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
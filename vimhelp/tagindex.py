@@ -0,0 +1,105 @@
+# Static tag index for client-side tag search ("go to keyword"). It is generated at
+# update time, and served (in one piece, as it is small) under a content-hashed URL, so
+# that browsers and the edge cache can keep it for a long time; a browser then needs at
+# most two requests (for the manifest, which gives that URL, and the index itself) for
+# all its tag searches. See 'searchTagIndex' in vimhelp-v5.js, which does the same
+# matching as tagsearch.py.
+
+import hashlib
+import json
+import urllib.parse
+
+import flask
+import werkzeug.exceptions
+
+from . import dbmodel
+
+
+CACHE_KEY_ID = "api/tagindex"
+
+# The manifest is small and changes with every update of the tags; the index can be
+# cached indefinitely, since its URL changes whenever its contents do.
+MANIFEST_MAX_AGE = 15 * 60
+INDEX_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def build_index(tags):
+    """
+    Build the index of the sorted list of (tag, href) pairs 'tags'. Return the index,
+    and the hash of its contents.
+
+    The index is a dict with the list of distinct HTML file names ("files"), and a list
+    of entries ("tags"), sorted by tag, each of which is a list of:
+    - the tag;
+    - the index of its HTML file in "files";
+    - only if it is not the usual "<file>#<quote_plus(tag)>", the whole href (else
+      null, if the next item is present);
+    - only for non-ASCII tags, the casefolded tag.
+    """
+    index = {"files": [], "tags": []}
+    file_indexes = {}
+    for tag, href in tags:
+        htmlfilename = href.partition("#")[0]
+        if (file_index := file_indexes.get(htmlfilename)) is None:
+            file_index = file_indexes[htmlfilename] = len(index["files"])
+            index["files"].append(htmlfilename)
+        entry = [tag, file_index]
+        if href != f"{htmlfilename}#{urllib.parse.quote_plus(tag)}":
+            entry.append(href)
+        if not tag.isascii():
+            if len(entry) == 2:
+                entry.append(None)
+            entry.append(tag.casefold())
+        index["tags"].append(entry)
+    return index, hashlib.sha1(encode(index)).hexdigest()[:16]
+
+
+def encode(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class TagIndexData:
+    """
+    The encoded manifest (the content hash of the index) and index of a project's tag
+    index, ready to be served.
+    """
+
+    def __init__(self, entity):
+        self.manifest = encode({"hash": entity.hash})
+        self.hash = entity.hash
+        self.index = encode(entity.index)
+
+
+def handle_manifest(cache):
+    resp = flask.Response(get_data(cache).manifest, mimetype="application/json")
+    resp.cache_control.public = True
+    resp.cache_control.max_age = MANIFEST_MAX_AGE
+    return resp
+
+
+def handle_index(content_hash, cache):
+    data = get_data(cache)
+    # A request for an out-of-date index can happen just after an update; the client
+    # then falls back to the tagsearch API.
+    if data.hash != content_hash:
+        raise werkzeug.exceptions.NotFound()
+    resp = flask.Response(data.index, mimetype="application/json")
+    resp.cache_control.public = True
+    resp.cache_control.max_age = INDEX_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
+
+
+def get_data(cache):
+    project = flask.g.project
+    return cache.get_or_load(
+        project, CACHE_KEY_ID, lambda: load_data(project), pinned=True
+    )
+
+
+def load_data(project):
+    with dbmodel.ndb_context():
+        entity = dbmodel.ClientTagIndex.get_by_id(project)
+        if entity is None:
+            raise werkzeug.exceptions.NotFound()
+        return TagIndexData(entity)
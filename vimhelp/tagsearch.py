@@ -1,9 +1,24 @@
+import array
 import bisect
+import collections
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import operator
+import sys
+import time
+import zlib
+from http import HTTPStatus
 
 import flask
 import werkzeug.exceptions
+import werkzeug.http
 
 from . import dbmodel
+from . import metrics
+from . import packing
 
 
 # There are about 10k tags. To optimize performance, consider:
@@ -12,79 +27,559 @@ from . import dbmodel
 
 
 MAX_RESULTS = 30
-CACHE_KEY_ID = "api/tag-items"
+CACHE_KEY_ID = "api/tag-index"
 
+# Maximum length of the substrings that are indexed by 'TagIndex'
+NGRAM_LEN = 3
 
-class TagItem:
-    def __init__(self, tag, href):
-        self.tag = tag
-        self.tag_lower = tag.casefold()
-        self.href = href
+# Number of recent queries whose responses are kept by each 'TagIndex'
+QUERY_CACHE_MAX_ENTRIES = 2000
 
-    def __lt__(self, query):
-        # This is enough for bisect_left to work...
-        return self.tag < query
+# Maximum number of tags that can be resolved in one request
+MAX_RESOLVE_TAGS = 1000
+
+# How long browsers and proxies may cache responses; the tags only change with updates
+MAX_AGE = 15 * 60
+
+_FORMAT_MAGIC = b"VHT1"
+
+# Query cache statistics since process start: "hits", "misses", and "prefix_reuses"
+# (misses answered by narrowing down the complete results of a shorter query)
+query_cache_stats = collections.Counter()
+
+metrics.Counter(
+    "vimhelp_tagsearch_query_cache_total",
+    "Tag search query cache events: hits, misses, and prefix_reuses (misses answered "
+    "by narrowing down the results of a shorter query)",
+    ("event",),
+    collect=lambda: {(event,): n for event, n in query_cache_stats.items()},
+)
+_STAGE_SECONDS = metrics.Histogram(
+    "vimhelp_tagsearch_stage_seconds",
+    "Time taken by each stage of tag searches (prefix, prefix_lower, substring, "
+    "substring_lower), and by encoding their results",
+    ("stage",),
+)
+_RESOLVE_SECONDS = metrics.Histogram(
+    "vimhelp_tagresolve_seconds",
+    "Time taken to resolve a tag (for tag redirects and tagresolve), by whether it was "
+    "found exactly",
+    ("exact",),
+)
+
+
+class TagIndex:
+    """
+    The tags, sorted, in columnar form: items are identified by their position, and
+    there is a list of tags, a list of casefolded tags, and the encoded JSON results,
+    all joined together. Also a view of the items sorted by casefolded tag, and n-gram
+    indexes of the tags and of the casefolded tags, for finding the items that start
+    with or contain a given string without scanning all of them.
+    """
+
+    def __init__(
+        self, tags, results, result_offsets, lower_order, ngrams, ngrams_lower
+    ):
+        # 'tags' is the sorted list of tags, and 'results' their encoded JSON results,
+        # joined together, with their offsets in 'result_offsets'; 'lower_order' is the
+        # positions of the items in order of casefolded tag, and 'ngrams' and
+        # 'ngrams_lower' are 'NgramIndex'es of the tags and casefolded tags.
+        self.tags = tags
+        self.tags_lower = casefold_tags(tags)
+        self._results = results
+        self._result_offsets = result_offsets
+        # Identifies the tags and hrefs, and hence the response to any query
+        self.version = hashlib.sha1(results).hexdigest()
+        self.response_headers = {
+            "Cache-Control": f"public, max-age={MAX_AGE}",
+            "ETag": werkzeug.http.quote_etag(self.version),
+        }
+        self._lower_order = lower_order
+        self._lower_tags = [self.tags_lower[pos] for pos in lower_order]
+        self._ngrams = ngrams
+        self._ngrams_lower = ngrams_lower
+        # Goes away along with the index, i.e. whenever the in-process cache is cleared
+        self.query_cache = QueryCache()
+
+    @classmethod
+    def build(cls, tags):
+        """
+        Build the index from 'tags', a sorted list of (tag, href) pairs.
+        """
+        tag_list = [tag for tag, _ in tags]
+        tags_lower = casefold_tags(tag_list)
+        results = [
+            encode_json({"id": tag, "text": tag, "href": href}) for tag, href in tags
+        ]
+        result_offsets = array.array(
+            "I", itertools.accumulate(map(len, results), initial=0)
+        )
+        lower_order = sorted(range(len(tag_list)), key=tags_lower.__getitem__)
+        return cls(
+            tag_list,
+            b"".join(results),
+            result_offsets,
+            array.array("I", lower_order),
+            NgramIndex.build(tag_list),
+            NgramIndex.build(tags_lower),
+        )
+
+    def to_bytes(self):
+        """
+        Return the index in a compact binary form, from which 'from_bytes' can load it
+        without building any of it again: the tags and n-grams joined by newlines
+        (which they never contain), and the arrays as they are in memory, except for
+        the n-gram positions, which are stored as differences (so they compress well,
+        and usually fit in 16 bits). The whole thing is compressed.
+        """
+        # The differences are between positions, so never more than the number of tags
+        delta_typecode = "h" if len(self.tags) <= 2**15 else "i"
+        header = {"ngram_len": NGRAM_LEN, "delta_typecode": delta_typecode}
+        chunks = [
+            _FORMAT_MAGIC,
+            packing.pack_blob(json.dumps(header).encode()),
+            packing.pack_blob("\n".join(self.tags).encode()),
+            packing.pack_blob(self._results),
+            packing.pack_array(self._result_offsets),
+            packing.pack_array(self._lower_order),
+        ]
+        for ngrams in (self._ngrams, self._ngrams_lower):
+            chunks += ngrams.packed_chunks(delta_typecode)
+        return zlib.compress(b"".join(chunks))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Load an index from the output of 'to_bytes'. Raise ValueError if it is not in
+        the format used by this version of the code.
+        """
+        data = memoryview(zlib.decompress(data))
+        if data[: len(_FORMAT_MAGIC)] != _FORMAT_MAGIC:
+            raise ValueError("bad tag index format")
+        pos = len(_FORMAT_MAGIC)
+        header, pos = packing.unpack_blob(data, pos)
+        header = json.loads(bytes(header))
+        if header["ngram_len"] != NGRAM_LEN:
+            raise ValueError("tag index has different n-gram length")
+        tags, pos = packing.unpack_blob(data, pos)
+        tags = str(tags, "utf-8").split("\n") if tags else []
+        results, pos = packing.unpack_blob(data, pos)
+        result_offsets, pos = packing.unpack_array(data, pos, "I")
+        lower_order, pos = packing.unpack_array(data, pos, "I")
+        ngrams, pos = NgramIndex.unpack(data, pos, header["delta_typecode"])
+        ngrams_lower, pos = NgramIndex.unpack(data, pos, header["delta_typecode"])
+        return cls(
+            tags, bytes(results), result_offsets, lower_order, ngrams, ngrams_lower
+        )
+
+    @functools.cached_property
+    def _positions(self):
+        # Map from tag to position; only built once a tag is resolved
+        return {tag: pos for pos, tag in enumerate(self.tags)}
+
+    def resolve(self, name):
+        """
+        Return the position of the item whose tag is 'name' and True; or, failing
+        that, the position of the best tagsearch match for 'name' and False; or, if
+        there is none, None and False.
+        """
+        start = time.perf_counter()
+        if (pos := self._positions.get(name)) is not None:
+            _RESOLVE_SECONDS.observe(time.perf_counter() - start, "true")
+            return pos, True
+        # Timed as a whole here, rather than as tagsearch stages
+        results = search(self, name, max_results=1, timed=False)
+        _RESOLVE_SECONDS.observe(time.perf_counter() - start, "false")
+        return (results[0] if results else None), False
+
+    def encode_result(self, pos):
+        """
+        Return the encoded JSON result for the item at 'pos'.
+        """
+        return self._results[self._result_offsets[pos] : self._result_offsets[pos + 1]]
+
+    def href(self, pos):
+        # Only kept as part of the encoded result, which is what is needed most of the
+        # time
+        return json.loads(self.encode_result(pos))["href"]
+
+    def encode_results(self, positions):
+        """
+        Return the tagsearch response body for the items at 'positions' (exactly as
+        'flask.jsonify' would encode it).
+        """
+        results = self._results
+        offsets = self._result_offsets
+        return b"".join(
+            (
+                b'{"results":[',
+                b",".join(
+                    results[offsets[pos] : offsets[pos + 1]] for pos in positions
+                ),
+                b"]}\n",
+            )
+        )
+
+    def starting_with(self, query):
+        """
+        Iterate, in order, over the positions of the items whose tag starts with
+        'query'.
+        """
+        tags = self.tags
+        for pos in range(bisect.bisect_left(tags, query), len(tags)):
+            if not tags[pos].startswith(query):
+                return
+            yield pos
+
+    def starting_with_lower(self, query):
+        """
+        Iterate, in order, over the positions of the items whose casefolded tag starts
+        with 'query'.
+        """
+        lo = bisect.bisect_left(self._lower_tags, query)
+        if query and query[-1] != chr(sys.maxunicode):
+            # Tags starting with 'query' sort before 'query' with its last character
+            # incremented.
+            upper = query[:-1] + chr(ord(query[-1]) + 1)
+            hi = bisect.bisect_left(self._lower_tags, upper, lo)
+        else:
+            hi = len(self._lower_tags)
+        return iter(sorted(self._lower_order[lo:hi]))
+
+    def containing(self, query, lower=False):
+        """
+        Iterate, in order, over the positions of the items whose tag contains 'query';
+        or, if 'lower' is set, whose casefolded tag does.
+        """
+        if not query:
+            yield from range(len(self.tags))
+            return
+        ngrams = self._ngrams_lower if lower else self._ngrams
+        if len(query) <= NGRAM_LEN:
+            yield from ngrams.get(query)
+            return
+        # Check the items that contain the rarest of the query's n-grams.
+        candidates = None
+        for i in range(len(query) - NGRAM_LEN + 1):
+            positions = ngrams.get(query[i : i + NGRAM_LEN])
+            if not positions:
+                return
+            if candidates is None or len(positions) < len(candidates):
+                candidates = positions
+        tags = self.tags_lower if lower else self.tags
+        for pos in candidates:
+            if query in tags[pos]:
+                yield pos
+
+
+class TagSubset:
+    """
+    A handful of items of a 'TagIndex', given by their positions in ascending order,
+    searchable in the same way as the 'TagIndex' by simply checking each one of them.
+    """
+
+    def __init__(self, index, positions):
+        self._index = index
+        self._positions = positions
+
+    def starting_with(self, query):
+        tags = self._index.tags
+        return (pos for pos in self._positions if tags[pos].startswith(query))
+
+    def starting_with_lower(self, query):
+        tags = self._index.tags_lower
+        return (pos for pos in self._positions if tags[pos].startswith(query))
+
+    def containing(self, query, lower=False):
+        tags = self._index.tags_lower if lower else self._index.tags
+        return (pos for pos in self._positions if query in tags[pos])
+
+
+class NgramIndex:
+    """
+    Maps each substring of up to NGRAM_LEN characters of a list of strings to the
+    positions (in ascending order) of the strings that contain it. The positions for
+    all substrings are stored in one array, in the manner of a CSR sparse matrix.
+    """
+
+    def __init__(self, ngrams, offsets, positions):
+        # 'ngrams' is the list of n-grams; the positions for the i-th one are
+        # 'positions[offsets[i] : offsets[i + 1]]'
+        self._ngrams = {ngram: i for i, ngram in enumerate(ngrams)}
+        self._offsets = offsets
+        self._positions = positions
+        self._view = memoryview(positions)
+
+    @classmethod
+    def build(cls, strings):
+        postings = {}
+        for pos, s in enumerate(strings):
+            ngrams = {
+                s[i : i + n]
+                for n in range(1, NGRAM_LEN + 1)
+                for i in range(len(s) - n + 1)
+            }
+            for ngram in ngrams:
+                if (positions := postings.get(ngram)) is None:
+                    positions = postings[ngram] = []
+                positions.append(pos)
+        offsets = array.array("I", [0])
+        all_positions = array.array("I")
+        for positions in postings.values():
+            all_positions.extend(positions)
+            offsets.append(len(all_positions))
+        return cls(list(postings), offsets, all_positions)
+
+    def packed_chunks(self, delta_typecode):
+        # See 'TagIndex.to_bytes'. Dicts keep their insertion order, so the n-grams are
+        # in the order of their offsets.
+        positions = self._positions
+        deltas = array.array(
+            delta_typecode,
+            map(operator.sub, positions, itertools.chain((0,), positions)),
+        )
+        return [
+            packing.pack_blob("\n".join(self._ngrams).encode()),
+            packing.pack_array(self._offsets),
+            packing.pack_array(deltas),
+        ]
+
+    @classmethod
+    def unpack(cls, data, pos, delta_typecode):
+        ngrams, pos = packing.unpack_blob(data, pos)
+        ngrams = str(ngrams, "utf-8").split("\n") if ngrams else []
+        offsets, pos = packing.unpack_array(data, pos, "I")
+        deltas, pos = packing.unpack_array(data, pos, delta_typecode)
+        return cls(ngrams, offsets, array.array("I", itertools.accumulate(deltas))), pos
+
+    def get(self, ngram):
+        """
+        Return the positions of the strings containing 'ngram', as a sequence.
+        """
+        if (i := self._ngrams.get(ngram)) is None:
+            return ()
+        return self._view[self._offsets[i] : self._offsets[i + 1]]
+
+
+class QueryCache:
+    """
+    LRU cache of the results of recent queries against a 'TagIndex'. Each entry is a
+    pair of the encoded JSON response, and (if there were fewer than MAX_RESULTS
+    results) the complete list of matching positions, in ascending order.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES):
+        self._entries = collections.OrderedDict()
+        self._max_entries = max_entries
+
+    def get(self, query):
+        if (entry := self._entries.get(query)) is not None:
+            self._entries.move_to_end(query)
+        return entry
+
+    def put(self, query, entry):
+        self._entries[query] = entry
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def narrowest_positions(self, query):
+        """
+        Return the complete results of the longest cached prefix of 'query', which are
+        all the items that can match 'query'; or None if there is no such prefix. That
+        is what happens as a user types, one keystroke at a time.
+        """
+        is_lower = query == query.casefold()
+        for n in range(len(query) - 1, -1, -1):
+            prefix = query[:n]
+            entry = self._entries.get(prefix)
+            if entry is None or entry[1] is None:
+                continue
+            # The case-insensitive stages only ran for the prefix if it was lowercase.
+            if is_lower and prefix != prefix.casefold():
+                continue
+            return entry[1]
+        return None
 
 
 def handle_tagsearch(cache):
-    project = flask.g.project
-    items = cache.get(project, CACHE_KEY_ID)
+    index = get_index(cache)
     query = flask.request.args.get("q", "")
-    if not items:
-        with dbmodel.ndb_context():
-            entity = dbmodel.TagsInfo.get_by_id(project)
-            if entity is None:
-                raise werkzeug.exceptions.NotFound()
-            items = [TagItem(*tag) for tag in entity.tags]
-            cache.put(project, CACHE_KEY_ID, items)
 
-    results = do_handle_tagsearch(items, query)
-    return flask.jsonify({"results": results})
+    if (resp := not_modified_response(index)) is not None:
+        return resp
+
+    query_cache = index.query_cache
+    if (entry := query_cache.get(query)) is not None:
+        query_cache_stats["hits"] += 1
+        data, _ = entry
+    else:
+        query_cache_stats["misses"] += 1
+        if (positions := query_cache.narrowest_positions(query)) is not None:
+            query_cache_stats["prefix_reuses"] += 1
+            source = TagSubset(index, positions)
+        else:
+            source = index
+        results = search(source, query)
+        start = time.perf_counter()
+        data = index.encode_results(results)
+        _STAGE_SECONDS.observe(time.perf_counter() - start, "encode")
+        # With fewer than MAX_RESULTS results, every stage of the search ran to the
+        # end, so 'results' is everything that matches 'query' in any way. Keep it
+        # around, as it includes everything that matches any longer query starting
+        # with this one.
+        if len(results) < MAX_RESULTS:
+            complete_positions = array.array("I", sorted(results))
+        else:
+            complete_positions = None
+        query_cache.put(query, (data, complete_positions))
+    return flask.Response(
+        data, mimetype="application/json", headers=index.response_headers
+    )
 
 
-def do_handle_tagsearch(items, query):
+def handle_tag(name, cache):
+    """
+    Redirect to the tag 'name', or to the best match for it.
+    """
+    index = get_index(cache)
+    pos, _ = index.resolve(name)
+    if pos is None:
+        raise werkzeug.exceptions.NotFound()
+    # Relative to the directory of the request path, '/tag/{name}', so that it works
+    # wherever the site is mounted. The hrefs of the tags in help.txt start at the site
+    # root ("/#tag"), which the "../" prefix already leads to.
+    url = "../" * (name.count("/") + 1) + index.href(pos).lstrip("/")
+    resp = flask.redirect(url, HTTPStatus.FOUND)
+    resp.headers["Cache-Control"] = index.response_headers["Cache-Control"]
+    return resp
+
+
+def handle_tagresolve(cache):
+    """
+    Resolve each of the tags given by the "tag" query/form parameters, like
+    'handle_tag', for tooling. The response is like that of tagsearch, with one result
+    per tag, e.g.
+    {"results":[{"exact":true,"query":"'ai'","result":{"href":...,"id":...,"text":...}},
+    {"exact":false,"query":"nonexistent","result":null}]}
+    """
+    index = get_index(cache)
+    names = flask.request.values.getlist("tag")
+    if len(names) > MAX_RESOLVE_TAGS:
+        raise werkzeug.exceptions.BadRequest(
+            f"Too many tags (maximum is {MAX_RESOLVE_TAGS})"
+        )
+
+    if (resp := not_modified_response(index)) is not None:
+        return resp
+
+    results = []
+    for name in names:
+        pos, exact = index.resolve(name)
+        results.append(
+            b'{"exact":%s,"query":%s,"result":%s}'
+            % (
+                b"true" if exact else b"false",
+                encode_json(name),
+                index.encode_result(pos) if pos is not None else b"null",
+            )
+        )
+    return flask.Response(
+        b"".join((b'{"results":[', b",".join(results), b"]}\n")),
+        mimetype="application/json",
+        headers=index.response_headers,
+    )
+
+
+def get_index(cache):
+    project = flask.g.project
+    return cache.get_or_load(
+        project, CACHE_KEY_ID, lambda: load_index(project), pinned=True
+    )
+
+
+def load_index(project):
+    with dbmodel.ndb_context():
+        entity = dbmodel.TagsInfo.get_by_id(project)
+        if entity is None:
+            raise werkzeug.exceptions.NotFound()
+        if entity.index is not None:
+            try:
+                return TagIndex.from_bytes(entity.index)
+            except ValueError as e:
+                logging.warning("cannot load stored tag index (%s), rebuilding it", e)
+        # Written by an older version, or too big to be stored
+        return TagIndex.build(entity.tags)
+
+
+def not_modified_response(index):
+    # Responses only change along with the tags, so they can be cached by browsers and
+    # proxies as well. (This is the gist of 'make_conditional', which is comparatively
+    # slow.)
+    if flask.request.if_none_match.contains_weak(index.version):
+        return flask.Response(
+            status=HTTPStatus.NOT_MODIFIED, headers=index.response_headers
+        )
+    return None
+
+
+def do_handle_tagsearch(index, query):
+    return index.encode_results(search(index, query))
+
+
+def casefold_tags(tags):
+    # Most tags are their own casefolded form, in which case they share the object
+    return [tag if (tag_lower := tag.casefold()) == tag else tag_lower for tag in tags]
+
+
+def encode_json(obj):
+    # Same as the output of 'flask.jsonify' (outside of debug mode)
+    return json.dumps(obj, sort_keys=True, separators=(",", ":")).encode()
+
+
+def search(source, query, max_results=MAX_RESULTS, timed=True):
+    """
+    Return the positions of up to 'max_results' items matching 'query', best matches
+    first. 'source' is a 'TagIndex', or a 'TagSubset' known to contain all the items
+    that can match. If 'timed', the time taken by each stage is observed in the
+    tagsearch stage metric.
+    """
     results = []
     result_set = set()
 
     is_lower = query == query.casefold()
 
-    def add_result(item):
-        if item.tag in result_set:
+    def add_result(pos):
+        if pos in result_set:
             return False
-        results.append({"id": item.tag, "text": item.tag, "href": item.href})
-        result_set.add(item.tag)
-        return len(results) == MAX_RESULTS
+        results.append(pos)
+        result_set.add(pos)
+        return len(results) == max_results
 
     # Find all tags beginning with query.
-    i = bisect.bisect_left(items, query)
-    for item in items[i:]:
-        if item.tag.startswith(query):
-            if add_result(item):
-                return results
-        else:
-            break
+    stages = [("prefix", source.starting_with)]
 
     # If we didn't find enough, and the query is all-lowercase, add all case-insensitive
     # matches.
     if is_lower:
-        for item in items:
-            if item.tag_lower.startswith(query):
-                if add_result(item):
-                    return results
+        stages.append(("prefix_lower", source.starting_with_lower))
 
     # If we still didn't find enough, additionally find all tags that contain query as a
     # substring.
-    for item in items:
-        if query in item.tag:
-            if add_result(item):
-                return results
+    stages.append(("substring", source.containing))
 
     # If we still didn't find enough, and the query is all-lowercase, additionally find
     # all tags that contain query as a substring case-insensitively.
     if is_lower:
-        for item in items:
-            if query in item.tag_lower:
-                if add_result(item):
-                    return results
+        stages.append(
+            ("substring_lower", lambda query: source.containing(query, lower=True))
+        )
+
+    for stage, find in stages:
+        start = time.perf_counter()
+        is_full = any(map(add_result, find(query)))
+        if timed:
+            _STAGE_SECONDS.observe(time.perf_counter() - start, stage)
+        if is_full:
+            break
 
     return results
@@ -21,17 +21,27 @@ import werkzeug.exceptions
 import google.cloud.ndb
 import google.cloud.tasks
 
+from .compression import Deflater
 from .dbmodel import (
+    ClientTagIndex,
     GlobalInfo,
+    ProcessedFileGzip,
     ProcessedFileHead,
     ProcessedFilePart,
+    ProcessedFileRefs,
     RawFileContent,
     RawFileInfo,
+    SearchIndexHead,
+    SearchIndexPart,
+    SearchTerms,
     TagsInfo,
     ndb_context,
 )
 from .http import HttpClient, HttpResponse
+from . import fulltext
 from . import secret
+from . import tagindex
+from . import tagsearch
 from . import vimh2h
 
 # Once we have consumed about ten minutes of CPU time, Google will throw us a
@@ -44,6 +54,17 @@ from . import vimh2h
 # there is risk of running out of memory on our puny worker node.
 CONCURRENCY = 5
 
+# Version of what 'to_html' stores for each processed file (ProcessedFileHead,
+# ProcessedFilePart, ProcessedFileGzip etc.). It is part of the cache key that tells
+# whether a file's translation is up to date (see '_translate'), so it must be bumped
+# whenever that changes, for all files to be translated and stored again; changes to
+# the translation itself (vimh2h.py and the page template) are already covered.
+PROCESSED_FORMAT_VERSION = 1
+
+# Number of processed file heads fetched at a time for their ETags (see
+# '_add_missing_cache_etags')
+ETAG_FETCH_BATCH_SIZE = 10
+
 TAGS_NAME = "tags"
 FAQ_NAME = "vim_faq.txt"
 HELP_NAME = "help.txt"
@@ -94,6 +115,10 @@ FAQ_BASE_URL = "https://raw.githubusercontent.com/chrisbra/vim_faq/master/doc/"
 
 PFD_MAX_PART_LEN = 995000
 
+# Maximum size of the stored tag search index, leaving room for the rest of the
+# 'TagsInfo' entity (whose total size is limited to 1 MiB)
+TAGS_INDEX_MAX_LEN = 850000
+
 
 class UpdateHandler(flask.views.MethodView):
     def post(self):
@@ -142,6 +167,10 @@ class UpdateHandler(flask.views.MethodView):
                 self._g = self._init_g(wipe=is_force)
                 self._g_dict_pre = self._g.to_dict()
                 self._had_exception = False
+                self._search_terms_changed = False
+                # Assigned back to 'self._g' at the end (it must be a new object for the
+                # comparison with 'self._g_dict_pre' to work)
+                self._cache_etags = dict(self._g.cache_etags or {})
                 if self._project == "vim":
                     self._do_update_vim(no_rfi=is_force)
                 elif self._project == "neovim":
@@ -149,6 +178,12 @@ class UpdateHandler(flask.views.MethodView):
                 else:
                     raise RuntimeError(f"unknown project '{self._project}'")
 
+                if self._search_terms_changed:
+                    self._save_search_index()
+
+                self._add_missing_cache_etags()
+                self._g.cache_etags = self._cache_etags
+
                 if not self._had_exception and self._g_dict_pre != self._g.to_dict():
                     self._g.put()
                     logging.info(
@@ -204,6 +239,9 @@ class UpdateHandler(flask.views.MethodView):
         # Kick off retrieval of all RawFileInfo entities from the Datastore
         rfi_greenlet = self._spawn(self._get_all_rfi, no_rfi)
 
+        # Kick off finding the files that have no search terms yet
+        missing_terms_greenlet = self._spawn(self._find_files_without_search_terms)
+
         # Check whether the master branch is updated, and whether we have a new vim
         # version
         get_git_refs_greenlet.get()
@@ -238,10 +276,17 @@ class UpdateHandler(flask.views.MethodView):
                 name for name, is_modified in docdir_greenlet.get() if is_modified
             }
 
+        missing_terms_names = missing_terms_greenlet.get()
+
         # Check FAQ download result
         faq_result = faq_greenlet.get()
         if not faq_result.is_modified:
-            if len(updated_file_names) == 0 and not is_new_vim_version:
+            if (
+                len(updated_file_names) == 0
+                and not is_new_vim_version
+                and self._tags_source_etags() == self._g.tags_source_etags
+                and not missing_terms_names
+            ):
                 logging.info("Nothing to do")
                 return
             faq_result = None
@@ -269,27 +314,46 @@ class UpdateHandler(flask.views.MethodView):
             mode="online",
             project="vim",
             version=version_from_tag(self._g.vim_version_tag),
-            tags=tags_result.content.decode(),
+            tags=tags_result.content,
         )
-        self._h2h.add_tags(FAQ_NAME, faq_result.content.decode())
+        self._h2h.add_tags(FAQ_NAME, faq_result.content)
 
         greenlets = []
 
         def track_spawn(f, *args, **kwargs):
             greenlets.append(self._spawn(f, *args, **kwargs))
 
-        # Save tags JSON if we may have updated tags
-        if tags_result.is_modified or faq_result.is_modified:
-            track_spawn(self._save_tags_json)
-
-        # Translate tags file if it was modified
-        if tags_result.is_modified:
+        # If we may have updated tags (now, or in an earlier update that failed before
+        # saving them), work out which files reference a tag that was added, removed or
+        # retargeted. The new tags JSON is only saved once these have all been
+        # translated again, since it is what we compare against.
+        tags_changed = (
+            tags_result.is_modified
+            or faq_result.is_modified
+            or self._tags_source_etags() != self._g.tags_source_etags
+        )
+        if tags_changed:
+            tags_affected_names = self._find_files_affected_by_tags()
+        else:
+            tags_affected_names = set()
+        # Files that were last translated before search terms were extracted from them
+        # are got and translated again in the same way, which saves their terms (and
+        # skips the HTML translation itself if it is up to date)
+        tags_affected_names |= missing_terms_names
+
+        # Translate tags file if it was modified, or if it references modified tags
+        if tags_result.is_modified or TAGS_NAME in tags_affected_names:
             track_spawn(self._translate, TAGS_NAME, tags_result.content)
 
         # Translate FAQ if it was modified, or if tags file was modified (because it
         # could lead to a different set of links in the FAQ)
-        if faq_result.is_modified or tags_result.is_modified:
+        if (
+            faq_result.is_modified
+            or tags_result.is_modified
+            or FAQ_NAME in tags_affected_names
+        ):
             track_spawn(self._translate, FAQ_NAME, faq_result.content)
+        tags_affected_names -= {TAGS_NAME, FAQ_NAME}
 
         # If we found a new vim version, ensure we translate help.txt, since we're
         # displaying the current vim version in the rendered help.txt.html
@@ -298,26 +362,51 @@ class UpdateHandler(flask.views.MethodView):
                 self._get_file_and_translate, HELP_NAME, translate_if_not_modified=True
             )
             updated_file_names.discard(HELP_NAME)
+            tags_affected_names.discard(HELP_NAME)
 
         # Translate all other modified files, after retrieving them from GitHub or
         # datastore (this also writes the raw file info to the datastore, if modified)
-        # TODO: theoretically we should re-translate all files (whether in
-        # updated_file_names or not) if the tags file was modified
-        for name in updated_file_names:
+        for name in updated_file_names - tags_affected_names:
             track_spawn(
                 self._get_file_and_translate, name, translate_if_not_modified=False
             )
 
+        # Re-translate files whose set of links may have changed due to modified tags.
+        # Their content is generally not kept in the datastore, so we need to
+        # unconditionally re-download them.
+        if tags_affected_names:
+            logging.info(
+                "Re-translating %d file(s) affected by tags changes or without search "
+                "terms",
+                len(tags_affected_names),
+            )
+        for name in tags_affected_names:
+            track_spawn(
+                self._get_file_and_translate,
+                name,
+                translate_if_not_modified=True,
+                sources="http",
+                force_http=True,
+            )
+
         logging.info("Waiting for everything to finish")
 
         self._join_greenlets(greenlets)
 
+        if tags_changed:
+            self._save_tags_json_if_translated()
+
     def _do_update_neovim(self, no_rfi):
 
         # Check whether we have a new Neovim version
         old_vim_version_tag = self._g.vim_version_tag
         self._get_git_refs()
-        if self._g.vim_version_tag == old_vim_version_tag:
+        # All files are translated (and their search terms saved) for a new version; a
+        # run for the same version is needed too if any of them have no search terms
+        if (
+            self._g.vim_version_tag == old_vim_version_tag
+            and not self._find_files_without_search_terms()
+        ):
             logging.info("Nothing to do")
             return
 
@@ -352,25 +441,24 @@ class UpdateHandler(flask.views.MethodView):
         # Wait for all tag additions to complete
         self._greenlet_pool.join(raise_error=True)
 
-        # Save tags JSON
-        greenlets = [self._spawn(self._save_tags_json)]
-
         logging.info("Beginning vimhelp-to-HTML conversions")
 
         # Kick off processing of all files, reading file contents from the Datastore,
         # where we just saved them all
-        for name in all_file_names:
-            greenlets.append(
-                self._spawn(
-                    self._get_file_and_translate,
-                    name,
-                    translate_if_not_modified=True,
-                    sources="db",
-                )
+        greenlets = [
+            self._spawn(
+                self._get_file_and_translate,
+                name,
+                translate_if_not_modified=True,
+                sources="db",
             )
+            for name in all_file_names
+        ]
 
         self._join_greenlets(greenlets)
 
+        self._save_tags_json_if_translated()
+
     def _get_git_refs(self):
         """
         Populate 'master_sha', 'vim_version_tag, 'refs_etag' members of 'self._g'
@@ -507,23 +595,202 @@ class UpdateHandler(flask.views.MethodView):
 
     def _save_tags_json(self):
         """
-        Obtain list of tag/link pairs from 'self._h2h' and save to Datastore.
+        Obtain list of tag/link pairs from 'self._h2h' and save to Datastore, along with
+        the tag search index built from them, and the tag index for client-side tag
+        search.
         """
         tags = self._h2h.sorted_tag_href_pairs()
-        logging.info("Saving %d %s (tag, href) pairs", len(tags), self._project)
-        TagsInfo(id=self._project, tags=tags).put()
+        client_index, client_index_hash = tagindex.build_index(tags)
+        tag_index = tagsearch.TagIndex.build(tags)
+        index = tag_index.to_bytes()
+        logging.info(
+            "Saving %d %s (tag, href) pairs, search index %d bytes",
+            len(tags),
+            self._project,
+            len(index),
+        )
+        if len(index) > TAGS_INDEX_MAX_LEN:
+            # The web app then builds the index from the tags.
+            logging.warning("Tag search index is too big to be stored")
+            index = None
+        google.cloud.ndb.put_multi(
+            [
+                TagsInfo(id=self._project, tags=tags, index=index),
+                ClientTagIndex(
+                    id=self._project, index=client_index, hash=client_index_hash
+                ),
+            ]
+        )
+        # Both are built from the tags alone
+        self._cache_etags[tagsearch.CACHE_KEY_ID] = tag_index.version
+        self._cache_etags[tagindex.CACHE_KEY_ID] = tag_index.version
+
+    def _save_tags_json_if_translated(self):
+        """
+        Save the tags JSON (see '_save_tags_json'), unless translating any of the files
+        failed: then the next update compares against the old tags again, and so
+        translates the files affected by the changes in them again.
+        """
+        if self._had_exception:
+            logging.warning(
+                "Not saving %s tags, since not all files were translated", self._project
+            )
+            return
+        self._save_tags_json()
+        self._g.tags_source_etags = self._tags_source_etags()
 
-    def _get_file_and_translate(self, name, translate_if_not_modified, sources=None):
+    def _tags_source_etags(self):
+        """
+        Return the HTTP ETags of the raw files that the tags are built from, as saved in
+        'GlobalInfo.tags_source_etags'; for Neovim, whose tags come from all the files,
+        there are none.
+        """
+        if self._project != "vim":
+            return None
+        etags = {}
+        for name in (TAGS_NAME, FAQ_NAME):
+            rfi = self._rfi_map.get(name)
+            if rfi is not None and rfi.etag is not None:
+                etags[name] = rfi.etag.decode()
+        return etags
+
+    def _save_search_terms(self, name, content):
+        """
+        Extract the full-text search terms from the given file and save them to
+        Datastore, unless the existing ones were extracted from the same content.
+        """
+        if name == TAGS_NAME:
+            return
+        terms_id = f"{self._project}:{name}"
+        content_hash = hashlib.sha1(content).digest()
+        old_terms = SearchTerms.get_by_id(terms_id)
+        if old_terms is not None and old_terms.content_hash == content_hash:
+            return
+        logging.info("Saving search terms of '%s:%s'", self._project, name)
+        terms, anchors, length = fulltext.extract_terms(content)
+        SearchTerms(
+            id=terms_id,
+            project=self._project,
+            content_hash=content_hash,
+            terms=terms,
+            anchors=anchors,
+            length=length,
+        ).put()
+        self._search_terms_changed = True
+
+    def _save_search_index(self):
+        """
+        Merge the search terms of all files into the full-text search index, and save it
+        to Datastore; unless some files have no search terms yet (if getting them failed
+        in this update), since the index would then be missing them.
+        """
+        if missing_terms_names := self._find_files_without_search_terms():
+            logging.warning(
+                "Not saving %s search index, since %d file(s) have no search terms: %s",
+                self._project,
+                len(missing_terms_names),
+                ", ".join(sorted(missing_terms_names)),
+            )
+            return
+        files = []
+        for terms in SearchTerms.query(SearchTerms.project == self._project):
+            name = terms.key.id().split(":")[1]
+            htmlfilename = self._h2h.html_filename(name)
+            files.append((name, htmlfilename, terms.terms, terms.anchors, terms.length))
+        data = fulltext.SearchIndex.build(files).to_bytes()
+        logging.info(
+            "Saving %s search index of %d file(s), %d bytes",
+            self._project,
+            len(files),
+            len(data),
+        )
+        etag = base64.b64encode(hashlib.sha1(data).digest())
+        parts = [
+            data[i : i + PFD_MAX_PART_LEN]
+            for i in range(0, len(data), PFD_MAX_PART_LEN)
+        ]
+        head = SearchIndexHead(
+            id=self._project, etag=etag, numparts=len(parts), data0=parts[0]
+        )
+        save_transactional(
+            [head]
+            + [
+                SearchIndexPart(id=f"{self._project}:{i}", data=part, etag=etag)
+                for i, part in enumerate(parts[1:], 1)
+            ]
+        )
+        self._cache_etags[fulltext.CACHE_KEY_ID] = etag.decode()
+
+    def _find_files_without_search_terms(self):
+        """
+        Return the set of names of the processed files that have no 'SearchTerms', i.e.
+        that were last translated before search terms were extracted from them (or
+        whose terms could not be saved). The tags file has none.
+        """
+        head_keys = ProcessedFileHead.query(
+            ProcessedFileHead.project == self._project
+        ).fetch(keys_only=True)
+        terms_keys = SearchTerms.query(SearchTerms.project == self._project).fetch(
+            keys_only=True
+        )
+        terms_ids = {key.id() for key in terms_keys}
+        return {
+            key.id().split(":")[1] for key in head_keys if key.id() not in terms_ids
+        } - {TAGS_NAME}
+
+    def _find_files_affected_by_tags(self):
+        """
+        Compare the tags in 'self._h2h' against those saved in the Datastore by the
+        previous update, and return the set of names of files whose last translation
+        looked up any tag that has since been added, removed or retargeted. Files
+        translated before we started recording their referenced tags (i.e. that have no
+        'ProcessedFileRefs') are all taken to be affected.
+        """
+        old_tags_info = TagsInfo.get_by_id(self._project)
+        old_tags = dict(old_tags_info.tags) if old_tags_info is not None else {}
+        new_tags = dict(self._h2h.sorted_tag_href_pairs())
+        changed_tags = {
+            tag
+            for tag in old_tags.keys() | new_tags.keys()
+            if old_tags.get(tag) != new_tags.get(tag)
+        }
+        logging.info("%d %s tag(s) changed", len(changed_tags), self._project)
+        if not changed_tags:
+            return set()
+        names = set()
+        query = ProcessedFileRefs.query(ProcessedFileRefs.project == self._project)
+        refs_ids = set()
+        for refs in query:
+            refs_ids.add(refs.key.id())
+            if not changed_tags.isdisjoint(refs.tags):
+                names.add(refs.key.id().split(":")[1])
+        head_keys = ProcessedFileHead.query(
+            ProcessedFileHead.project == self._project
+        ).fetch(keys_only=True)
+        unknown_names = {
+            key.id().split(":")[1] for key in head_keys if key.id() not in refs_ids
+        }
+        if unknown_names:
+            logging.info(
+                "%d %s file(s) have no recorded tag references",
+                len(unknown_names),
+                self._project,
+            )
+        return names | unknown_names
+
+    def _get_file_and_translate(
+        self, name, translate_if_not_modified, sources=None, force_http=False
+    ):
         """
         Get file with given 'name' and translate to HTML.
         'translate_if_not_modified' controls whether to translate to HTML even if the
         file was not modified.
-        'sources' is as for '_get_file'; a sensible default based on
-        'translate_if_not_modified' is chosen if not provided.
+        'sources' and 'force_http' are as for '_get_file'; a sensible default for
+        'sources' based on 'translate_if_not_modified' is chosen if not provided.
         """
         if sources is None:
             sources = "http,db" if translate_if_not_modified else "http"
-        result = self._get_file(name, sources)
+        result = self._get_file(name, sources, force_http=force_http)
         if translate_if_not_modified or result.is_modified:
             self._translate(name, result.content)
 
@@ -533,13 +800,15 @@ class UpdateHandler(flask.views.MethodView):
         'sources' is as for '_get_file'.
         """
         result = self._get_file(name, sources)
-        self._h2h.add_tags(name, result.content.decode())
+        self._h2h.add_tags(name, result.content)
 
-    def _get_file(self, name, sources, base_url=None):
+    def _get_file(self, name, sources, base_url=None, force_http=False):
         """
         Get file with given 'name' via HTTP and/or from the Datastore, based on
         'sources', which should be one of "http", "db", "http,db". If a new/modified
         file was retrieved via HTTP, save raw file (info) to Datastore as needed.
+        If 'force_http' is set, the HTTP request is made unconditionally, i.e. without
+        an 'If-None-Match' header.
         """
         rfi = self._rfi_map.get(name)
         result = None
@@ -552,7 +821,7 @@ class UpdateHandler(flask.views.MethodView):
                 rfi = self._rfi_map[name] = RawFileInfo(
                     id=f"{self._project}:{name}", project=self._project
                 )
-            if rfi.etag is not None:
+            if rfi.etag is not None and not force_http:
                 headers["If-None-Match"] = rfi.etag.decode()
             logging.info("Fetching %s", url)
             response = self._http_client.get(url, headers)
@@ -581,14 +850,64 @@ class UpdateHandler(flask.views.MethodView):
 
     def _translate(self, name, content):
         """
-        Translate given file to HTML and save to Datastore.
+        Translate given file to HTML and save to Datastore, unless the existing
+        translation is known to be up to date.
         """
+        self._save_search_terms(name, content)
+        refs_id = f"{self._project}:{name}"
+        old_refs = ProcessedFileRefs.get_by_id(refs_id)
+        if old_refs is not None and old_refs.cache_key == self._h2h.cache_key(
+            name, content, old_refs.tags, PROCESSED_FORMAT_VERSION
+        ):
+            logging.info(
+                "HTML translation of '%s:%s' is up to date", self._project, name
+            )
+            return
         logging.info("Translating '%s:%s' to HTML", self._project, name)
-        phead, pparts = to_html(self._project, name, content, self._h2h)
+        phead, pparts, pgzip = to_html(self._project, name, content, self._h2h)
+        tags = sorted(self._h2h.referenced_tags(name))
+        refs = ProcessedFileRefs(
+            id=refs_id,
+            project=self._project,
+            tags=tags,
+            cache_key=self._h2h.cache_key(
+                name, content, tags, PROCESSED_FORMAT_VERSION
+            ),
+        )
         logging.info(
             "Saving HTML translation of '%s:%s' to Datastore", self._project, name
         )
-        save_transactional([phead] + pparts)
+        entities = [phead, refs] + pparts
+        if pgzip is not None:
+            entities.append(pgzip)
+        save_transactional(entities)
+        self._cache_etags[name] = phead.etag.decode()
+
+    def _add_missing_cache_etags(self):
+        """
+        Add the ETags of the processed files that are not in 'self._cache_etags' yet,
+        i.e. that have not been translated since it was first saved (or since a forced
+        update), taking them from the Datastore. Without them, the web app could not
+        tell that these files are unchanged, and would reload them after every update.
+        """
+        keys = ProcessedFileHead.query(
+            ProcessedFileHead.project == self._project
+        ).fetch(keys_only=True)
+        missing = [
+            key for key in keys if key.id().split(":")[1] not in self._cache_etags
+        ]
+        if not missing:
+            return
+        logging.info(
+            "Adding %s cache ETags of %d processed files", self._project, len(missing)
+        )
+        # In batches, as each head holds (the first part of) a whole page
+        for i in range(0, len(missing), ETAG_FETCH_BATCH_SIZE):
+            batch = missing[i : i + ETAG_FETCH_BATCH_SIZE]
+            for phead in google.cloud.ndb.get_multi(batch):
+                if phead is not None:
+                    name = phead.key.id().split(":")[1]
+                    self._cache_etags[name] = phead.etag.decode()
 
     def _get_all_rfi(self, no_rfi):
         if no_rfi:
@@ -631,28 +950,66 @@ class GetFileResult:
 
 
 def to_html(project, name, content, h2h):
-    content_str = content.decode()
-    html = h2h.to_html(name, content_str).encode()
-    etag = base64.b64encode(sha1(html))
-    datalen = len(html)
+    """
+    Translate raw file 'content' to HTML, returning a '(ProcessedFileHead,
+    [ProcessedFilePart], ProcessedFileGzip)' tuple; the latter is None if the
+    compressed HTML is too large. The HTML is encoded, hashed, compressed and split into
+    parts as it is generated, a chunk at a time, so there is no complete copy of it
+    other than the parts themselves; these are all held, as they are saved together
+    with the head. On top of them, translating takes memory in proportion to the raw
+    file (mostly for the tags it looks up, see 'VimH2H.referenced_tags'), and filling
+    up the parts another part's length at most.
+    """
     phead = ProcessedFileHead(
-        id=f"{project}:{name}", project=project, encoding=b"UTF-8", etag=etag
+        id=f"{project}:{name}", project=project, encoding=b"UTF-8", numparts=0
     )
     pparts = []
-    if datalen > PFD_MAX_PART_LEN:
-        phead.numparts = 0
-        for i in range(0, datalen, PFD_MAX_PART_LEN):
-            part = html[i : (i + PFD_MAX_PART_LEN)]
-            if i == 0:
-                phead.data0 = part
-            else:
-                partname = f"{project}:{name}:{phead.numparts}"
-                pparts.append(ProcessedFilePart(id=partname, data=part, etag=etag))
-            phead.numparts += 1
+    digest = hashlib.sha1()
+    deflater = Deflater()
+
+    def add_part(data):
+        if phead.numparts == 0:
+            phead.data0 = data
+        else:
+            partname = f"{project}:{name}:{phead.numparts}"
+            pparts.append(ProcessedFilePart(id=partname, data=data))
+        phead.numparts += 1
+
+    buf = bytearray()
+    for chunk in h2h.to_html_chunks(name, content):
+        data = chunk.encode()
+        digest.update(data)
+        deflater.update(data)
+        # Filled up to the part length at most, so each part is copied only once
+        view = memoryview(data)
+        while view:
+            room = PFD_MAX_PART_LEN - len(buf)
+            buf += view[:room]
+            view = view[room:]
+            if len(buf) == PFD_MAX_PART_LEN:
+                add_part(bytes(buf))
+                buf.clear()
+    if buf or phead.numparts == 0:
+        add_part(bytes(buf))
+
+    phead.etag = base64.b64encode(digest.digest())
+    for part in pparts:
+        part.etag = phead.etag
+
+    deflated = deflater.finish()
+    if len(deflated) <= PFD_MAX_PART_LEN:
+        pgzip = ProcessedFileGzip(
+            id=f"{project}:{name}",
+            data=deflated,
+            crc32=deflater.crc32,
+            size=deflater.size,
+            etag=phead.etag,
+        )
     else:
-        phead.numparts = 1
-        phead.data0 = html
-    return phead, pparts
+        logging.warning("Compressed '%s:%s' is too large to store", project, name)
+        pgzip = None
+
+    return phead, pparts, pgzip
 
 
 def save_raw_file(rfi, content):
@@ -686,12 +1043,6 @@ def version_from_tag(version_tag):
         return version_tag
 
 
-def sha1(content):
-    digest = hashlib.sha1()
-    digest.update(content)
-    return digest.digest()
-
-
 def handle_enqueue_update():
     req = flask.request
 
@@ -1,11 +1,15 @@
 # Translates Vim documentation to HTML
 
-import flask
 import functools
+import hashlib
 import html
+import pathlib
 import re
 import urllib.parse
 
+import jinja2
+import markupsafe
+
 
 class VimProject:
     name = "Vim"
@@ -31,8 +35,14 @@ NeovimProject.other = VimProject
 
 PROJECTS = {"vim": VimProject, "neovim": NeovimProject}
 
+TEMPLATES_DIR = pathlib.Path(__file__).resolve().parent.parent / "templates"
+
 FAQ_LINE = '<a href="vim_faq.txt.html#vim_faq.txt" class="l">vim_faq.txt</a>   Frequently Asked Questions\n'
 
+# Number of pieces of translated output to join into each chunk of page content when
+# streaming
+CONTENT_CHUNK_PIECES = 4096
+
 RE_TAGLINE = re.compile(r"(\S+)\s+(\S+)")
 
 PAT_WORDCHAR = "[!#-)+-{}~\xC0-\xFF]"
@@ -60,20 +70,22 @@ PAT_WORD = (
 )
 
 RE_LINKWORD = re.compile(PAT_OPTWORD + "|" + PAT_CTRL + "|" + PAT_SPECIAL)
+# The alternatives that make up the regex used for tokenizing each line, in order of
+# precedence. Each pattern has exactly one capturing group.
 # fmt: off
-RE_TAGWORD = re.compile(
-    PAT_HEADER + "|" +
-    PAT_GRAPHIC + "|" +
-    PAT_PIPEWORD + "|" +
-    PAT_STARWORD + "|" +
-    PAT_COMMAND + "|" +
-    PAT_OPTWORD + "|" +
-    PAT_CTRL + "|" +
-    PAT_SPECIAL + "|" +
-    PAT_TITLE + "|" +
-    PAT_NOTE + "|" +
-    PAT_URL + "|" +
-    PAT_WORD
+TAGWORD_ALTERNATIVES = (
+    ("header",   PAT_HEADER),
+    ("graphic",  PAT_GRAPHIC),
+    ("pipeword", PAT_PIPEWORD),
+    ("starword", PAT_STARWORD),
+    ("command",  PAT_COMMAND),
+    ("opt",      PAT_OPTWORD),
+    ("ctrl",     PAT_CTRL),
+    ("special",  PAT_SPECIAL),
+    ("title",    PAT_TITLE),
+    ("note",     PAT_NOTE),
+    ("url",      PAT_URL),
+    ("word",     PAT_WORD),
 )
 # fmt: on
 RE_NEWLINE = re.compile(r"[\r\n]")
@@ -91,39 +103,79 @@ RE_STARTAG = re.compile(r'\*([^ \t"*]+)\*(?:\s|$)')
 RE_LOCAL_ADD = re.compile(r"LOCAL ADDITIONS:\s+\*local-additions\*$")
 
 
-class Link:
-    def __init__(self, filename, htmlfilename, tag):
-        self.filename = filename
-        self._htmlfilename = htmlfilename
-        if tag == "help-tags" and filename == "tags":
-            self._tag_quoted = None
-        else:
-            self._tag_quoted = urllib.parse.quote_plus(tag)
-        self._tag_escaped = html_escape(tag)
-        self._cssclass = "d"
-        if m := RE_LINKWORD.match(tag):
-            opt, ctrl, special = m.groups()
-            if opt is not None:
-                self._cssclass = "o"
-            elif ctrl is not None:
-                self._cssclass = "k"
-            elif special is not None:
-                self._cssclass = "s"
-
-    @functools.cache
-    def href(self, is_same_doc):
-        if self._tag_quoted is None:
-            return self._htmlfilename
-        doc = "" if is_same_doc else self._htmlfilename
-        return f"{doc}#{self._tag_quoted}"
-
-    @functools.cache
-    def html(self, is_pipe, is_same_doc):
-        cssclass = "l" if is_pipe else self._cssclass
-        return (
-            f'<a href="{self.href(is_same_doc)}" class="{cssclass}">'
-            f"{self._tag_escaped}</a>"
-        )
+_tagword_res = {}
+
+
+def tagword_re(line):
+    # Returns a '(regex, kinds)' pair, where 'regex' matches exactly like the
+    # alternation of all TAGWORD_ALTERNATIVES would on 'line', but only consists of
+    # those alternatives that could possibly match somewhere in it (e.g. there can be no
+    # "pipeword" without a '|'). For most lines, that is only "word", which is much
+    # faster to match. 'kinds' maps each group index to its alternative's name.
+    # fmt: off
+    key = (
+        line.endswith("~"),
+        line.endswith(" `"),
+        "|" in line,
+        "*" in line,
+        "`" in line,
+        "'" in line,
+        "CTRL-" in line or "META-" in line or "ALT-" in line,
+        "<" in line or "{" in line or "[" in line,
+        "Vim version" in line or "VIM REFERENCE" in line,
+        "note" in line or "NOTE" in line or "Note" in line,
+        "://" in line,
+    )
+    # fmt: on
+    if (result := _tagword_res.get(key)) is None:
+        alternatives = [
+            alt for alt, is_possible in zip(TAGWORD_ALTERNATIVES, key) if is_possible
+        ]
+        alternatives.append(TAGWORD_ALTERNATIVES[-1])
+        regex = re.compile("|".join(pattern for _, pattern in alternatives))
+        kinds = (None, *(kind for kind, _ in alternatives))
+        result = _tagword_res[key] = regex, kinds
+    return result
+
+
+def tag_definitions(contents):
+    # Iterate over the '(line number, tag)' pairs of the tags defined (as '*tag*') in
+    # 'contents', outside of examples; line numbers start at 1
+    in_example = False
+    for lineno, line in enumerate(RE_NEWLINE.split(to_str(contents)), 1):
+        if in_example:
+            if RE_EG_END.match(line):
+                in_example = False
+            else:
+                continue
+        for anchor in RE_STARTAG.finditer(line):
+            yield lineno, anchor.group(1)
+        if RE_EG_START.match(line):
+            in_example = True
+
+
+def link_href(tag, link, is_same_doc):
+    filename, htmlfilename = link
+    if tag == "help-tags" and filename == "tags":
+        return htmlfilename
+    doc = "" if is_same_doc else htmlfilename
+    return f"{doc}#{urllib.parse.quote_plus(tag)}"
+
+
+def link_html(tag, link, is_pipe, is_same_doc):
+    cssclass = "l" if is_pipe else "d"
+    if not is_pipe and (m := RE_LINKWORD.match(tag)):
+        opt, ctrl, special = m.groups()
+        if opt is not None:
+            cssclass = "o"
+        elif ctrl is not None:
+            cssclass = "k"
+        elif special is not None:
+            cssclass = "s"
+    return (
+        f'<a href="{link_href(tag, link, is_same_doc)}" class="{cssclass}">'
+        f"{html_escape(tag)}</a>"
+    )
 
 
 class VimH2H:
@@ -131,48 +183,75 @@ class VimH2H:
         self._mode = mode
         self._project = PROJECTS[project]
         self._version = version
-        self._urls = {}
+        # Map from tag to '(filename, htmlfilename)'
+        self._links = {}
+        # Generated link HTML for each tag, one map per combination of 'is_pipe' and
+        # 'is_same_doc' (see 'maplink'); populated on demand
+        self._link_htmls = ({}, {}, {}, {})
+        self._referenced_tags = {}
         if tags is not None:
-            for line in RE_NEWLINE.split(tags):
+            for line in RE_NEWLINE.split(to_str(tags)):
                 if m := RE_TAGLINE.match(line):
                     tag, filename = m.group(1, 2)
                     self.do_add_tag(filename, tag)
-        self._urls["help-tags"] = Link("tags", "tags.html", "help-tags")
+        self._links["help-tags"] = ("tags", "tags.html")
 
     def add_tags(self, filename, contents):
-        in_example = False
-        for line in RE_NEWLINE.split(contents):
-            if in_example:
-                if RE_EG_END.match(line):
-                    in_example = False
-                else:
-                    continue
-            for anchor in RE_STARTAG.finditer(line):
-                tag = anchor.group(1)
-                self.do_add_tag(filename, tag)
-            if RE_EG_START.match(line):
-                in_example = True
+        for _, tag in tag_definitions(contents):
+            self.do_add_tag(filename, tag)
 
     def do_add_tag(self, filename, tag):
+        self._links[tag] = (filename, self.html_filename(filename))
+        for htmls in self._link_htmls:
+            htmls.pop(tag, None)
+
+    def html_filename(self, filename):
         if self._mode == "online" and filename == "help.txt":
-            htmlfilename = "/"
-        else:
-            htmlfilename = filename + ".html"
-        self._urls[tag] = Link(filename, htmlfilename, tag)
+            return "/"
+        return filename + ".html"
 
     def sorted_tag_href_pairs(self):
         result = [
-            (tag, link.href(is_same_doc=False)) for tag, link in self._urls.items()
+            (tag, link_href(tag, link, is_same_doc=False))
+            for tag, link in self._links.items()
         ]
         result.sort()
         return result
 
+    def cache_key(self, filename, contents, referenced_tags, format_version=None):
+        # Hash of everything that the translation of 'filename' with the given
+        # 'contents' depends on, assuming that it looks up 'referenced_tags' (the result
+        # of 'referenced_tags()' when it was last translated): if the key matches, the
+        # translation would be identical. 'format_version' is that of whatever the
+        # caller makes of the translation, if it is kept along with the key.
+        digest = hashlib.sha1(renderer_version())
+        # The version is only displayed in help.txt, so other files need not be
+        # translated again just because of a new version.
+        version = self._version if filename == "help.txt" else None
+        params = (self._mode, self._project.name, filename, version, format_version)
+        digest.update(repr(params).encode())
+        if isinstance(contents, str):
+            contents = contents.encode()
+        digest.update(hashlib.sha1(contents).digest())
+        for tag in sorted(referenced_tags):
+            digest.update(repr((tag, self._links.get(tag))).encode())
+        return digest.digest()
+
+    def referenced_tags(self, filename):
+        # All tags looked up while translating 'filename' (whether or not they turned
+        # into links); if none of these change, neither does the translation.
+        return self._referenced_tags.get(filename, set())
+
     def maplink(self, tag, curr_filename, css_class=None):
-        links = self._urls.get(tag)
-        if links is not None:
+        self._referenced_tags[curr_filename].add(tag)
+        link = self._links.get(tag)
+        if link is not None:
             is_pipe = css_class == "l"
-            is_same_doc = links.filename == curr_filename
-            return links.html(is_pipe, is_same_doc)
+            is_same_doc = link[0] == curr_filename
+            htmls = self._link_htmls[is_pipe + 2 * is_same_doc]
+            if (html := htmls.get(tag)) is None:
+                html = htmls[tag] = link_html(tag, link, is_pipe, is_same_doc)
+            return html
         elif css_class is not None:
             return f'<span class="{css_class}">{html_escape(tag)}</span>'
         else:
@@ -191,110 +270,133 @@ class VimH2H:
         tag = base_tag
         i = 0
         while True:
-            link = self._urls.get(tag)
-            if link is None or link.filename != curr_filename:
+            self._referenced_tags[curr_filename].add(tag)
+            link = self._links.get(tag)
+            if link is None or link[0] != curr_filename:
                 return tag
             tag + f"{base_tag}_{i}"
             i += 1
 
     @staticmethod
+    @functools.cache
     def prelude(theme):
-        return flask.render_template("prelude.html", theme=theme)
+        return get_template("prelude.html").render(theme=theme)
 
     def to_html(self, filename, contents):
-        is_help_txt = filename == "help.txt"
-        lines = [line.rstrip("\r\n") for line in RE_NEWLINE.split(contents)]
+        return "".join(self.to_html_chunks(filename, contents))
+
+    def to_html_chunks(self, filename, contents):
+        text = to_str(contents)
+        self._referenced_tags[filename] = set()
+
+        # The sidebar comes before the content in the page, so the headings are found
+        # in a (cheap) pass of their own; the content is then translated bit by bit, as
+        # the page is generated, so that it is never all held at once. Neither is the list
+        # of lines, which would take several times the size of the text.
+        headings = {}
+        for idx, line_kind, line, _, m in classify_lines(split_lines(text)):
+            if line_kind == "heading":
+                heading = m.group(1)
+                if m := RE_STARTAG.search(line):
+                    headings[idx] = (m.group(1), heading, False)
+                else:
+                    tag = self.synthesize_tag(filename, heading)
+                    headings[idx] = (tag, heading, True)
+        sidebar_headings = [
+            markupsafe.Markup(
+                f'<a href="#{urllib.parse.quote_plus(tag)}">{html_escape(heading)}</a>'
+            )
+            for tag, heading, _ in headings.values()
+        ]
+
+        static_dir = "/" if self._mode == "online" else ""
+        helptxt = "./" if self._mode == "online" else "help.txt.html"
+
+        return get_template("page.html").generate(
+            mode=self._mode,
+            project=self._project,
+            version=self._version,
+            filename=filename,
+            static_dir=static_dir,
+            helptxt=helptxt,
+            content=self._content_chunks(filename, text, headings),
+            sidebar_headings=sidebar_headings,
+        )
 
+    def _content_chunks(self, filename, text, headings):
+        # Yield the translation of 'text' in chunks of (about) CONTENT_CHUNK_PIECES
+        # pieces; 'headings' maps the index of each heading line to '(tag, heading,
+        # is_synthesized)'.
+        is_help_txt = filename == "help.txt"
         out = []
-        sidebar_headings = []
-        in_example = False
-        for idx, line in enumerate(lines):
-            line_tabs = line
-            line = line.expandtabs()
-            prev_line_tabs = "" if idx == 0 else lines[idx - 1]
-            if prev_line_tabs == "" and idx > 1:
-                prev_line_tabs = lines[idx - 2]
-            if in_example:
-                if RE_EG_END.match(line):
-                    in_example = False
-                    if line[0] == "<":
-                        line = line[1:]
-                else:
-                    out.extend(('<span class="e">', html_escape(line), "</span>\n"))
-                    continue
-            if RE_HRULE.match(line_tabs):
+        for idx, line_kind, line, line_tabs, m in classify_lines(split_lines(text)):
+            if len(out) >= CONTENT_CHUNK_PIECES:
+                yield markupsafe.Markup("".join(out))
+                out = []
+            if line_kind == "example":
+                out.extend(('<span class="e">', html_escape(line), "</span>\n"))
+                continue
+            if line_kind == "hrule":
                 out.extend(('<span class="h">', html_escape(line), "</span>\n"))
                 continue
-            if RE_EG_START.match(line_tabs):
-                in_example = True
-                line = line[:-1]
             span_opened = False
-            if m := RE_SECTION.match(line_tabs):
+            if line_kind == "section":
                 out.extend(('<span class="c">', m.group(1), "</span>"))
                 line = line[m.end(1) :]
-            elif RE_HRULE1.match(prev_line_tabs) and (m := RE_HEADING.match(line)):
-                heading = m.group(1)
-                if m := RE_STARTAG.search(line):
-                    tag = m.group(1)
-                else:
-                    tag = self.synthesize_tag(filename, heading)
+            elif line_kind == "heading":
+                tag, _, is_synthesized = headings[idx]
+                if is_synthesized:
                     out.append(f'<span id="{tag}">')
                     span_opened = True
-                tag_escaped = urllib.parse.quote_plus(tag)
-                sidebar_headings.append(
-                    flask.Markup(f'<a href="#{tag_escaped}">{html_escape(heading)}</a>')
-                )
             is_faq_line = (
                 self._project is VimProject
                 and is_help_txt
                 and RE_LOCAL_ADD.match(line_tabs)
             )
             lastpos = 0
-            for match in RE_TAGWORD.finditer(line):
+            regex, kinds = tagword_re(line)
+            for match in regex.finditer(line):
                 pos = match.start()
                 if pos > lastpos:
                     out.append(html_escape(line[lastpos:pos]))
                 lastpos = match.end()
-                # fmt: off
-                (header, graphic, pipeword, starword, command, opt, ctrl, special,
-                 title, note, url, word) = match.groups()
-                # fmt: on
-                if pipeword is not None:
-                    out.append(self.maplink(pipeword, filename, "l"))
-                elif starword is not None:
+                group = match.lastindex
+                kind = kinds[group]
+                text = match[group]
+                if kind == "word":
+                    out.append(self.maplink(text, filename))
+                elif kind == "pipeword":
+                    out.append(self.maplink(text, filename, "l"))
+                elif kind == "starword":
                     out.extend(
                         (
                             '<span id="',
-                            urllib.parse.quote_plus(starword),
+                            urllib.parse.quote_plus(text),
                             '" class="t">',
-                            html_escape(starword),
+                            html_escape(text),
                             "</span>",
                         )
                     )
-                elif command is not None:
-                    out.extend(('<span class="e">', html_escape(command), "</span>"))
-                elif opt is not None:
-                    out.append(self.maplink(opt, filename, "o"))
-                elif ctrl is not None:
-                    out.append(self.maplink(ctrl, filename, "k"))
-                elif special is not None:
-                    out.append(self.maplink(special, filename, "s"))
-                elif title is not None:
-                    out.extend(('<span class="i">', html_escape(title), "</span>"))
-                elif note is not None:
-                    out.extend(('<span class="n">', html_escape(note), "</span>"))
-                elif header is not None:
+                elif kind == "command":
+                    out.extend(('<span class="e">', html_escape(text), "</span>"))
+                elif kind == "opt":
+                    out.append(self.maplink(text, filename, "o"))
+                elif kind == "ctrl":
+                    out.append(self.maplink(text, filename, "k"))
+                elif kind == "special":
+                    out.append(self.maplink(text, filename, "s"))
+                elif kind == "title":
+                    out.extend(('<span class="i">', html_escape(text), "</span>"))
+                elif kind == "note":
+                    out.extend(('<span class="n">', html_escape(text), "</span>"))
+                elif kind == "header":
+                    out.extend(('<span class="h">', html_escape(text[:-1]), "</span>"))
+                elif kind == "graphic":
+                    out.append(html_escape(text[:-2]))
+                elif kind == "url":
                     out.extend(
-                        ('<span class="h">', html_escape(header[:-1]), "</span>")
+                        ('<a class="u" href="', text, '">', html_escape(text), "</a>")
                     )
-                elif graphic is not None:
-                    out.append(html_escape(graphic[:-2]))
-                elif url is not None:
-                    out.extend(
-                        ('<a class="u" href="', url, '">', html_escape(url), "</a>")
-                    )
-                elif word is not None:
-                    out.append(self.maplink(word, filename))
             if lastpos < len(line):
                 out.append(html_escape(line[lastpos:]))
             if span_opened:
@@ -302,23 +404,94 @@ class VimH2H:
             out.append("\n")
             if is_faq_line:
                 out.append(FAQ_LINE)
+        if out:
+            yield markupsafe.Markup("".join(out))
+
+
+def split_lines(text):
+    """
+    Iterate over the lines of 'text', like 'RE_NEWLINE.split(text)' but without making
+    a list of them.
+    """
+    pos = 0
+    for m in RE_NEWLINE.finditer(text):
+        yield text[pos : m.start()]
+        pos = m.end()
+    yield text[pos:]
+
+
+def classify_lines(lines):
+    """
+    Yield '(index, kind, line, line_tabs, match)' for each of 'lines' (of a help file),
+    where 'kind' is "example" (a line inside an example), "hrule", "section" (a line
+    starting with a section name, 'match' being that of RE_SECTION), "heading" (a
+    heading below a "===" rule, 'match' being that of RE_HEADING) or "text";
+    'line_tabs' is the line as it is, and 'line' the line with tabs expanded, and
+    without the marker of the start or end of an example.
+    """
+    in_example = False
+    # The previous line, and the one before it
+    prev, prev2 = "", ""
+    for idx, line_tabs in enumerate(lines):
+        line = line_tabs.expandtabs()
+        prev_line_tabs = prev if prev != "" else prev2
+        prev, prev2 = line_tabs, prev
+        if in_example:
+            if RE_EG_END.match(line):
+                in_example = False
+                if line[0] == "<":
+                    line = line[1:]
+            else:
+                yield idx, "example", line, line_tabs, None
+                continue
+        if RE_HRULE.match(line_tabs):
+            yield idx, "hrule", line, line_tabs, None
+            continue
+        if RE_EG_START.match(line_tabs):
+            in_example = True
+            line = line[:-1]
+        if m := RE_SECTION.match(line_tabs):
+            yield idx, "section", line, line_tabs, m
+        elif RE_HRULE1.match(prev_line_tabs) and (m := RE_HEADING.match(line)):
+            yield idx, "heading", line, line_tabs, m
+        else:
+            yield idx, "text", line, line_tabs, None
 
-        static_dir = "/" if self._mode == "online" else ""
-        helptxt = "./" if self._mode == "online" else "help.txt.html"
 
-        return flask.render_template(
-            "page.html",
-            mode=self._mode,
-            project=self._project,
-            version=self._version,
-            filename=filename,
-            static_dir=static_dir,
-            helptxt=helptxt,
-            content=flask.Markup("".join(out)),
-            sidebar_headings=sidebar_headings,
-        )
+@functools.cache
+def renderer_version():
+    # Changes whenever this module or the page template does
+    digest = hashlib.sha1(pathlib.Path(__file__).read_bytes())
+    digest.update((TEMPLATES_DIR / "page.html").read_bytes())
+    return digest.digest()
+
+
+@functools.cache
+def get_template(name):
+    # Templates are compiled once, and rendered without needing a Flask app
+    return _jinja_env().get_template(name)
 
 
 @functools.cache
+def _jinja_env():
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+        autoescape=True,
+        trim_blocks=True,
+        lstrip_blocks=True,
+        auto_reload=False,
+    )
+
+
+def to_str(contents):
+    # Accept UTF-8 'bytes' (or 'memoryview' etc.) as well as 'str'
+    if isinstance(contents, str):
+        return contents
+    return str(contents, "utf-8")
+
+
+# Bounded, as it is called with all sorts of text (such as the lines of examples), but
+# most calls are with words and the like that come up over and over again
+@functools.lru_cache(maxsize=16384)
 def html_escape(s):
     return html.escape(s, quote=False)
@@ -1,18 +1,61 @@
 # Retrieve a help page from the data store, and present to the user
 
+import collections
+import datetime
 import logging
 from http import HTTPStatus
 
 import flask
+import gevent
+import gevent.pool
 import werkzeug.exceptions
+import werkzeug.wsgi
 
 from google.cloud import ndb
 
+from . import compression
 from . import dbmodel
+from . import metrics
+from . import sharedstore
 from . import vimh2h
 
 
-def handle_vimhelp(filename, cache):
+# The most requested pages (also loaded by warmup requests), which are kept in the cache
+# for good
+PINNED_FILENAMES = ("help.txt", "options.txt")
+
+# Number of the most requested pages of each project that are loaded into the cache in
+# advance, after a warmup request or an update, and how many at a time
+PREWARM_PAGES = 30
+PREWARM_CONCURRENCY = 4
+
+# Number of requests for a project's pages that a process must have served before it
+# goes by (and saves) its own idea of which pages are the most requested; until then,
+# it goes by the last saved one
+HOT_PAGES_MIN_REQUESTS = 200
+HOT_PAGES_SAVE_INTERVAL_SEC = 30 * 60
+
+# Size of the blocks in which the pages in a shared store are copied out of it, for
+# responses that cannot be sent straight from its file (see 'complete_response')
+BODY_BLOCK_SIZE = 64 * 1024
+
+# Number of requests for each page since process start, keyed by (project, filename)
+page_request_counts = collections.Counter()
+
+_DATASTORE_FETCH_SECONDS = metrics.Histogram(
+    "vimhelp_datastore_fetch_seconds",
+    "Time taken to fetch the entities of a processed file (or the parts of a search "
+    "index) from the datastore, by kind (head or parts)",
+    ("kind",),
+)
+_GET_PARTS_RETRIES = metrics.Counter(
+    "vimhelp_get_parts_retries_total",
+    "Fetches of the parts of a processed file or search index that were retried "
+    "because they did not match the head",
+)
+
+
+def handle_vimhelp(filename, cache, is_warmup=False):
     req = flask.request
     project = flask.g.project
 
@@ -29,72 +72,285 @@ def handle_vimhelp(filename, cache):
     if theme not in ("light", "dark"):
         theme = None
 
-    if entry := cache.get(project, filename):
-        logging.info("serving '%s:%s' from inproc cache", project, filename)
-        head, parts = entry
-        resp = prepare_response(req, head, theme)
-        return complete_response(resp, head, parts, theme)
+    page = get_page(project, filename, cache)
+    # Warmup requests would make the pages they load look popular
+    if not is_warmup:
+        page_request_counts[project, filename] += 1
+
+    # Pages too big to be kept gzipped are always sent uncompressed
+    use_gzip = page.gzip_bodies is not None and req.accept_encodings.quality("gzip") > 0
+
+    resp = prepare_response(
+        req, page.etag, page.modified, page.encoding, theme, use_gzip
+    )
+    return complete_response(resp, page, theme, use_gzip)
 
+
+def get_page(project, filename, cache):
+    return cache.get_or_load(
+        project,
+        filename,
+        lambda: load_page(project, filename, cache.shared_store),
+        pinned=filename in PINNED_FILENAMES,
+    )
+
+
+def load_page(project, filename, shared_store=None):
+    # With a shared store, the page is taken from it if another process (or this one,
+    # before the page was evicted) has put it there already; otherwise it is put there
+    # after being loaded from the datastore. Either way, it then refers to the store's
+    # copy of its data.
+    store = shared_store.current(project) if shared_store is not None else None
+    if store is not None and (record := store.get(filename)) is not None:
+        return CachedPage.from_record(*record, store.path)
     with dbmodel.ndb_context():
-        logging.info("serving '%s:%s' from datastore", project, filename)
-        head = dbmodel.ProcessedFileHead.get_by_id(f"{project}:{filename}")
+        metrics.debug_sampled("loading '%s:%s' from datastore", project, filename)
+        with _DATASTORE_FETCH_SECONDS.time("head"):
+            head = dbmodel.ProcessedFileHead.get_by_id(f"{project}:{filename}")
         if head is None:
             logging.warning("%s:%s not found in datastore", project, filename)
             raise werkzeug.exceptions.NotFound()
-        resp = prepare_response(req, head, theme)
-        parts = []
-        if resp.status_code != HTTPStatus.NOT_MODIFIED:
-            parts = get_parts(head)
-            complete_response(resp, head, parts, theme)
-        if head.numparts == 1 or parts:
-            cache.put(project, filename, (head, parts))
-        return resp
+        gzip_future = ndb.Key("ProcessedFileGzip", head.key.id()).get_async()
+        parts = get_parts(head)
+        gzip = gzip_future.result()
+        if gzip is not None and gzip.etag != head.etag:
+            gzip = None
+        page = CachedPage(
+            head.etag.decode(),
+            head.modified,
+            head.encoding,
+            b"".join((head.data0, *(p.data for p in parts))),
+            (gzip.data, gzip.crc32, gzip.size) if gzip is not None else None,
+        )
+    if (
+        store is not None
+        and (record := store.put(filename, *page.to_record())) is not None
+    ):
+        return CachedPage.from_record(*record, store.path)
+    return page
+
+
+class CachedPage:
+    """
+    A processed file, ready to be sent for each theme, in plain (not ndb) objects.
+    The response bodies are tuples of byte strings (or memoryviews, for a page in a
+    shared store), all sharing the same copy of the bulk of the page. For a page in a
+    shared store, those for the default theme can also be opened as files (see
+    'open_file').
+    """
+
+    THEMES = (None, "light", "dark")
+
+    def __init__(self, etag, modified, encoding, body, gzip):
+        # 'gzip' is the '(data, crc32, size)' of the 'ProcessedFileGzip', or None if
+        # there is none
+        self.etag = etag
+        self.modified = modified
+        self.encoding = encoding
+        self._body = body
+        self._gzip = gzip
+        # For a page in a shared store, the path of its file, and the '(offset,
+        # length)' of the plain and the gzipped response body for the default theme in
+        # it, in that order (see 'from_record')
+        self._store_path = None
+        self._store_ranges = None
+        preludes = {
+            theme: vimh2h.VimH2H.prelude(theme=theme).encode() for theme in self.THEMES
+        }
+        self.bodies = {theme: (preludes[theme], body) for theme in self.THEMES}
+        if gzip is not None:
+            self.gzip_bodies = {
+                theme: compression.gzip_chunks(preludes[theme], *gzip)
+                for theme in self.THEMES
+            }
+        else:
+            self.gzip_bodies = None
 
+    def to_record(self):
+        """
+        Return the page as '(metadata, blobs)', for a shared store. The blobs are the
+        response bodies for the default theme, plain and gzipped, each in one piece in
+        the store, so that they can be sent straight from its file.
+        """
+        metadata = {
+            "etag": self.etag,
+            "modified": self.modified.isoformat(),
+            "encoding": self.encoding.decode(),
+        }
+        blobs = list(self.bodies[None])
+        if self._gzip is not None:
+            _, metadata["gzip_crc32"], metadata["gzip_size"] = self._gzip
+            gzip_header, prelude_deflated, data, trailer = self.gzip_bodies[None]
+            blobs += [gzip_header + prelude_deflated, data, trailer]
+        return metadata, blobs
 
-def prepare_response(req, head, theme):
+    @classmethod
+    def from_record(cls, metadata, blobs, offset, path):
+        if len(blobs) > 2:
+            gzip = (blobs[3], metadata["gzip_crc32"], metadata["gzip_size"])
+        else:
+            gzip = None
+        page = cls(
+            metadata["etag"],
+            datetime.datetime.fromisoformat(metadata["modified"]),
+            metadata["encoding"].encode(),
+            blobs[1],
+            gzip,
+        )
+        page._store_path = path
+        plain_length = len(blobs[0]) + len(blobs[1])
+        gzip_length = sum(map(len, blobs[2:]))
+        page._store_ranges = (
+            (offset, plain_length),
+            (offset + plain_length, gzip_length),
+        )
+        return page
+
+    def open_file(self, use_gzip):
+        """
+        Return a file-like object (see 'sharedstore.RangeFile') of the plain or
+        gzipped response body for the default theme, if the page is in a shared store
+        (and its file is still there); otherwise return None.
+        """
+        if self._store_path is None:
+            return None
+        return sharedstore.open_range(self._store_path, *self._store_ranges[use_gzip])
+
+
+def prewarm(project, cache):
+    """
+    Load the most requested pages of 'project' into the cache (those that are not
+    there yet).
+    """
+    filenames = most_requested_pages(project)
+    if filenames is None:
+        with dbmodel.ndb_context():
+            hot_pages = dbmodel.HotPages.get_by_id(project)
+        filenames = hot_pages.filenames if hot_pages is not None else []
+    logging.info("prewarming %d %s page(s)", len(filenames), project)
+    pool = gevent.pool.Pool(PREWARM_CONCURRENCY)
+    for filename in filenames[:PREWARM_PAGES]:
+        pool.spawn(_prewarm_page, project, filename, cache)
+    pool.join()
+
+
+def _prewarm_page(project, filename, cache):
+    try:
+        get_page(project, filename, cache)
+    except Exception:
+        logging.exception("failed to prewarm '%s:%s'", project, filename)
+
+
+def most_requested_pages(project):
+    """
+    Return the names of the PREWARM_PAGES most requested pages of 'project', as served
+    by this process, most requested first; or None if it has not served enough
+    requests for them to go by.
+    """
+    counts = collections.Counter(
+        {
+            filename: n
+            for (p, filename), n in page_request_counts.items()
+            if p == project
+        }
+    )
+    if counts.total() < HOT_PAGES_MIN_REQUESTS:
+        return None
+    return [filename for filename, _ in counts.most_common(PREWARM_PAGES)]
+
+
+def save_hot_pages_loop():
+    """
+    Save the most requested pages of each project every HOT_PAGES_SAVE_INTERVAL_SEC
+    (if they changed), for new processes to prewarm.
+    """
+    saved = {}
+    while True:
+        gevent.sleep(HOT_PAGES_SAVE_INTERVAL_SEC)
+        for project in {project for project, _ in page_request_counts}:
+            filenames = most_requested_pages(project)
+            if filenames is None or filenames == saved.get(project):
+                continue
+            logging.info("saving %d hot %s page(s)", len(filenames), project)
+            try:
+                with dbmodel.ndb_context():
+                    dbmodel.HotPages(id=project, filenames=filenames).put()
+            except Exception:
+                logging.exception("failed to save hot %s pages", project)
+                continue
+            saved[project] = filenames
+
+
+def prepare_response(req, etag, modified, encoding, theme, use_gzip):
     resp = flask.Response(mimetype="text/html")
-    resp.charset = head.encoding
-    resp.last_modified = head.modified
+    resp.charset = encoding
+    resp.last_modified = modified
     resp.cache_control.max_age = 15 * 60
     resp.vary.add("Cookie")
-    resp.set_etag(head.etag.decode() + (theme or ""))
+    resp.vary.add("Accept-Encoding")
+    # The gzipped body is a different representation, and so needs a different (strong)
+    # ETag; otherwise caches could answer a conditional request for one with the other
+    resp.set_etag(etag + (theme or "") + ("-gz" if use_gzip else ""))
     return resp.make_conditional(req)
 
 
-def complete_response(resp, head, parts, theme):
+def complete_response(resp, page, theme, use_gzip):
     if resp.status_code != HTTPStatus.NOT_MODIFIED:
-        logging.info(
-            "writing %d-part response, modified %s",
-            1 + len(parts),
-            resp.last_modified,
-        )
-        prelude = vimh2h.VimH2H.prelude(theme=theme).encode()
-        resp.data = b"".join((prelude, head.data0, *(p.data for p in parts)))
+        if use_gzip:
+            body = page.gzip_bodies[theme]
+            resp.content_encoding = "gzip"
+        else:
+            body = page.bodies[theme]
+        resp.content_length = sum(map(len, body))
+        if theme is None and (f := page.open_file(use_gzip)) is not None:
+            # Sent by the WSGI server straight from the shared store's file (with
+            # 'os.sendfile', if it supports that, as gunicorn does)
+            resp.response = werkzeug.wsgi.wrap_file(flask.request.environ, f)
+            resp.direct_passthrough = True
+        elif all(isinstance(chunk, bytes) for chunk in body):
+            resp.response = list(body)
+        else:
+            resp.response = _body_blocks(body)
     return resp
 
 
+def _body_blocks(body):
+    # WSGI servers take only byte strings, so other responses for a page in a shared
+    # store are copied out of it, but only a block at a time.
+    for chunk in body:
+        if isinstance(chunk, bytes):
+            yield chunk
+        else:
+            for i in range(0, len(chunk), BODY_BLOCK_SIZE):
+                yield bytes(chunk[i : i + BODY_BLOCK_SIZE])
+
+
 def redirect(url):
-    logging.info("redirecting %s to %s", flask.request.path, url)
+    metrics.debug_sampled("redirecting %s to %s", flask.request.path, url)
     return flask.redirect(url, HTTPStatus.MOVED_PERMANENTLY)
 
 
-def get_parts(head):
+def get_parts(head, kind="ProcessedFilePart"):
+    """
+    Return the parts (entities of the given 'kind') of 'head', a 'ProcessedFileHead' or
+    other entity split into parts in the same way, in order.
+    """
     # We could alternatively achieve this via an ancestor query (retrieving the head and
     # its parts simultaneously) to give us strong consistency.
     if head.numparts == 1:
         return []
-    logging.info("retrieving %d extra part(s)", head.numparts - 1)
+    metrics.debug_sampled("retrieving %d extra part(s)", head.numparts - 1)
     head_id = head.key.id()
-    keys = [
-        ndb.Key("ProcessedFilePart", f"{head_id}:{i}") for i in range(1, head.numparts)
-    ]
+    keys = [ndb.Key(kind, f"{head_id}:{i}") for i in range(1, head.numparts)]
     num_tries = 0
     while True:
-        parts = ndb.get_multi(keys)
-        if all(p.etag == head.etag for p in parts):
+        with _DATASTORE_FETCH_SECONDS.time("parts"):
+            parts = ndb.get_multi(keys)
+        if all(p is not None and p.etag == head.etag for p in parts):
             return sorted(parts, key=lambda p: p.key.string_id())
         num_tries += 1
         if num_tries >= 10:
             logging.error("tried too many times, giving up")
             raise werkzeug.exceptions.InternalServerError()
         logging.warning("got differing etags, retrying")
+        _GET_PARTS_RETRIES.inc()
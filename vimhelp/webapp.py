@@ -14,6 +14,7 @@ import flask  # noqa: E402
 import logging  # noqa: E402
 import os  # noqa: E402
 import pathlib  # noqa: E402
+import time  # noqa: E402
 
 
 _CSP = "default-src 'self' https://cdn.jsdelivr.net"
@@ -37,10 +38,16 @@ _URL_PREFIX_REDIRECTS = (
 
 _WARMUP_PATH = "/_ah/warmup"
 
+_METRICS_PATH = "/_admin/metrics"
+
 
 def create_app():
     from . import cache
+    from . import fulltext
+    from . import metrics
     from . import robots
+    from . import sharedstore
+    from . import tagindex
     from . import tagsearch
     from . import vimhelp
     from . import update
@@ -49,19 +56,39 @@ def create_app():
 
     logging.basicConfig(level=logging.INFO)
 
-    cache = cache.Cache()
+    # With a shared store (see sharedstore.py), the app can be run in several worker
+    # processes without keeping a copy of each page in each of them.
+    if shared_store_dir := os.environ.get("VIMHELP_SHARED_STORE_DIR"):
+        shared_store = sharedstore.SharedStore(
+            shared_store_dir,
+            int(
+                os.environ.get(
+                    "VIMHELP_SHARED_STORE_MAX_BYTES", sharedstore.DEFAULT_CAPACITY
+                )
+            ),
+        )
+    else:
+        shared_store = None
+
+    cache = cache.Cache(
+        int(os.environ.get("VIMHELP_CACHE_MAX_BYTES", cache.DEFAULT_MAX_BYTES)),
+        shared_store,
+    )
+    cache.export_metrics()
+
+    request_seconds = metrics.Histogram(
+        "vimhelp_request_seconds",
+        "Time taken to handle requests, by endpoint",
+        ("endpoint",),
+    )
 
     app = flask.Flask(
         "vimhelp",
         root_path=package_path,
         static_url_path="",
         static_folder="../static",
-        template_folder="../templates",
     )
 
-    app.jinja_options["trim_blocks"] = True
-    app.jinja_options["lstrip_blocks"] = True
-
     is_dev = os.environ.get("VIMHELP_ENV") == "dev"
     if not is_dev:
         app.config["PREFERRED_URL_SCHEME"] = "https"
@@ -69,14 +96,15 @@ def create_app():
     @app.before_request
     def before():
         req = flask.request
+        flask.g.start_time = time.perf_counter()
 
         # Redirect away from legacy / non-HTTPS URL prefixes
-        if req.path not in (_WARMUP_PATH, "/update"):
+        if req.path not in (_WARMUP_PATH, _METRICS_PATH, "/update"):
             for redir_from, redir_to in _URL_PREFIX_REDIRECTS:
                 if req.url_root in redir_from:
                     path = req.full_path if req.query_string else req.path
                     new_url = redir_to + req.root_path + path
-                    logging.info("redirecting %s to %s", req.url, new_url)
+                    metrics.debug_sampled("redirecting %s to %s", req.url, new_url)
                     return flask.redirect(new_url, HTTPStatus.MOVED_PERMANENTLY)
 
         # Flask's subdomain/host matching doesn't seem compatible with having multiple
@@ -92,9 +120,10 @@ def create_app():
         logging.info("doing warmup request for %s", project)
         with app.test_request_context():
             flask.g.project = project
-            vimhelp.handle_vimhelp("", cache)
-            vimhelp.handle_vimhelp("options.txt", cache)
+            vimhelp.handle_vimhelp("", cache, is_warmup=True)
+            vimhelp.handle_vimhelp("options.txt", cache, is_warmup=True)
             tagsearch.handle_tagsearch(cache)
+        gevent.spawn(vimhelp.prewarm, project, cache)
 
     @app.route(_WARMUP_PATH)
     def warmup():
@@ -102,6 +131,8 @@ def create_app():
             do_warmup(project)
         return flask.Response()
 
+    app.add_url_rule(_METRICS_PATH, view_func=metrics.handle_metrics)
+
     bp = flask.Blueprint("bp", "vimhelp", root_path=package_path)
 
     @bp.route("/<filename>.html")
@@ -113,6 +144,26 @@ def create_app():
     def vimhelp_tagsearch():
         return tagsearch.handle_tagsearch(cache)
 
+    @bp.route("/api/search")
+    def vimhelp_search():
+        return fulltext.handle_search(cache)
+
+    @bp.route("/api/tagresolve", methods=("GET", "POST"))
+    def vimhelp_tagresolve():
+        return tagsearch.handle_tagresolve(cache)
+
+    @bp.route("/tag/<path:name>")
+    def vimhelp_tag(name):
+        return tagsearch.handle_tag(name, cache)
+
+    @bp.route("/api/tagindex.json")
+    def vimhelp_tagindex_manifest():
+        return tagindex.handle_manifest(cache)
+
+    @bp.route("/api/tagindex.<content_hash>.json")
+    def vimhelp_tagindex(content_hash):
+        return tagindex.handle_index(content_hash, cache)
+
     @bp.route("/favicon.ico")
     def favicon():
         return app.send_static_file(f"favicon-{flask.g.project}.ico")
@@ -127,9 +178,18 @@ def create_app():
     if is_dev:
         app.register_blueprint(bp, name="neovim", url_prefix="/neovim")
 
+    @app.after_request
+    def after(response):
+        if (start_time := flask.g.get("start_time")) is not None:
+            request_seconds.observe(
+                time.perf_counter() - start_time, flask.request.endpoint or "none"
+            )
+        return response
+
     app.after_request(_add_default_headers)
 
     gevent.spawn(cache.start_refresh_loop, do_warmup)
+    gevent.spawn(vimhelp.save_hot_pages_loop)
 
     logging.info("app initialised")
 